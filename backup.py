@@ -1,260 +1,2324 @@
 #!/usr/bin/env python3
 
-import os, os.path, sys, shutil, signal, glob
+import os, os.path, sys, re, errno, time, queue, shutil, signal, threading, sqlite3
+import hashlib, json, gzip, atexit, heapq, cProfile, pstats, tarfile, struct
+import select, ctypes, ctypes.util, urllib.parse
 import logging, logging.handlers
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from optparse import OptionParser, OptionGroup
 
 
+# set by the first Ctrl-C - no new work is started, the copies
+# already running are allowed to finish, and everything is flushed
+stopping = threading.Event()
+
 def signal_handler(signal, frame):
-    print("Ctrl-C received")
-    sys.exit(0)
+    if stopping.is_set():
+        print("Ctrl-C received again - quitting")
+        sys.exit(0)
+    print("Ctrl-C received - finishing the copies in progress (Ctrl-C again to quit now)")
+    stopping.set()
+
+def globToRegex(pattern:str):
+    # translate a glob pattern into a regular expression. Unlike
+    # fnmatch, '*' and '?' stop at a '/' and '**' crosses them
+    res = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if i < n and pattern[i] == '*':
+                i += 1
+                if i < n and pattern[i] == '/':
+                    # "**/" also matches no directories at all
+                    i += 1
+                    res.append("(?:.*/)?")
+                else:
+                    res.append(".*")
+            else:
+                res.append("[^/]*")
+        elif c == '?':
+            res.append("[^/]")
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                # no closing bracket - take it literally
+                res.append("\\[")
+            else:
+                chars = pattern[i:j].replace("\\", "\\\\")
+                if chars[0] in "!^":
+                    chars = "^" + chars[1:]
+                res.append("[" + chars + "]")
+                i = j + 1
+        else:
+            res.append(re.escape(c))
+    return "".join(res)
+
+
+class Matcher:
+    """A list of INCLUDE/EXCLUDE patterns compiled into a single test.
+    Patterns use the usual glob syntax - '*' and '?' match within one
+    path component, '[...]' matches a set of characters and '**' also
+    matches across '/'. A pattern without a '/' is matched against the
+    name of the entry. A pattern starting with '/' is matched against
+    its full path, and any other pattern containing a '/' against the
+    trailing components of the path.
+
+    The common cases - exact names and "*.ext" style suffixes - are
+    set lookups, and everything else is combined into one regular
+    expression, so the cost of a test doesn't grow with the number
+    of patterns"""
+
+    def __init__(self, patterns:list):
+        self.names = set()
+        self.extensions = set()
+        self.suffixes = []
+        self.prefixes = []
+        nameRegex = []
+        pathRegex = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if 0 == len(pattern):
+                continue
+            if '/' in pattern:
+                if pattern[0] == '/':
+                    pathRegex.append(globToRegex(pattern))
+                else:
+                    pathRegex.append("(?:.*/)?" + globToRegex(pattern))
+                continue
+            wild = [c for c in pattern if c in "*?["]
+            if not wild:
+                self.names.add(pattern)
+            elif wild == ['*'] and pattern[0] == '*':
+                suffix = pattern[1:]
+                if suffix.startswith('.') and '.' not in suffix[1:]:
+                    self.extensions.add(suffix)
+                else:
+                    self.suffixes.append(suffix)
+            elif wild == ['*'] and pattern[-1] == '*':
+                self.prefixes.append(pattern[:-1])
+            else:
+                nameRegex.append(globToRegex(pattern))
+        self.suffixes = tuple(self.suffixes)
+        self.prefixes = tuple(self.prefixes)
+        self.nameRegex = None
+        self.pathRegex = None
+        if nameRegex:
+            self.nameRegex = re.compile("|".join("(?:" + r + ")" for r in nameRegex), re.DOTALL)
+        if pathRegex:
+            self.pathRegex = re.compile("|".join("(?:" + r + ")" for r in pathRegex), re.DOTALL)
+
+    def match(self, name:str, path:str):
+        if name in self.names:
+            return True
+        if self.extensions:
+            dot = name.rfind('.')
+            if 0 <= dot and name[dot:] in self.extensions:
+                return True
+        if self.suffixes and name.endswith(self.suffixes):
+            return True
+        if self.prefixes and name.startswith(self.prefixes):
+            return True
+        if self.nameRegex is not None and self.nameRegex.fullmatch(name):
+            return True
+        if self.pathRegex is not None and self.pathRegex.fullmatch(path):
+            return True
+        return False
+
+
+# limits for jobs=auto
+AUTO_JOBS_MAX = 16
+AUTO_JOBS_START = 2
+AUTO_WINDOW = 2.0
+
+class CopyPool:
+    """Bounded set of worker threads that perform the copies handed
+    to it by the directory walker. The number of copies waiting for a
+    worker is capped so that walking a large tree doesn't queue up
+    an unbounded number of pending copies. With jobs set to "auto",
+    the number of copies running at once is tuned as they run - it
+    keeps being stepped the same way while that moves the data faster,
+    and is turned back once it makes things slower, or only makes each
+    copy take longer"""
+
+    def __init__(self, jobs, p:dict):
+        self.p = p
+        self.auto = jobs == "auto"
+        if self.auto:
+            workers = AUTO_JOBS_MAX
+            self.limit = AUTO_JOBS_START
+        else:
+            workers = jobs
+            self.limit = jobs
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(2 * workers)
+        self.cond = threading.Condition()
+        self.running = 0
+        # what happened over the current window, and the last one
+        self.step = 1
+        self.windowStart = time.monotonic()
+        self.windowBytes = p["stats"].get("bytes")
+        self.windowCopies = 0
+        self.windowLatency = 0.0
+        self.lastRate = None
+        self.lastLatency = None
+
+    def run(self, fn, args):
+        if not self.auto:
+            fn(*args)
+            return
+        with self.cond:
+            while self.running >= self.limit:
+                self.cond.wait()
+            self.running += 1
+        start = time.monotonic()
+        try:
+            fn(*args)
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.finished(time.monotonic() - start)
+                self.cond.notify_all()
+
+    def finished(self, seconds:float):
+        # called with the lock held
+        self.windowCopies += 1
+        self.windowLatency += seconds
+        now = time.monotonic()
+        elapsed = now - self.windowStart
+        if elapsed < AUTO_WINDOW or self.windowCopies < self.limit:
+            return
+        nbytes = self.p["stats"].get("bytes")
+        rate = (nbytes - self.windowBytes) / elapsed
+        latency = self.windowLatency / self.windowCopies
+        if self.lastRate is not None:
+            if rate < self.lastRate * 0.95:
+                # the last step made things worse - go back
+                self.step = -self.step
+            elif rate < self.lastRate * 1.05 and latency > self.lastLatency * 1.5:
+                # no faster, but each copy is waiting longer
+                self.step = -1
+        self.lastRate = rate
+        self.lastLatency = latency
+        limit = min(max(self.limit + self.step, 1), AUTO_JOBS_MAX)
+        if limit != self.limit:
+            self.p["log"].debug("Copying %s files at a time - %.1f MB/s, %.3fs a file", limit, rate / 1e6, latency)
+            self.limit = limit
+        elif self.limit in (1, AUTO_JOBS_MAX):
+            # at the end of the range - try the other way next time
+            self.step = -self.step
+        self.windowStart = now
+        self.windowBytes = nbytes
+        self.windowCopies = 0
+        self.windowLatency = 0.0
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.run, fn, args)
+        except:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def parseJobs(value):
+    # a number of copy workers, or "auto"
+    if str(value).strip().lower() == "auto":
+        return "auto"
+    return int(value)
+
+
+class TokenBucket:
+    """Bandwidth limit shared by every copy drawing on it. Copies take
+    tokens for the bytes they move, and wait once the bucket is in debt.
+    If given, window is the (start, end) minute of the day the limit
+    applies over - outside of it the copies run flat out"""
+
+    def __init__(self, rate:int, window=None):
+        self.rate = rate
+        self.window = window
+        self.capacity = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def active(self):
+        if self.window is None:
+            return True
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        start, end = self.window
+        if start <= end:
+            return start <= minute < end
+        # the window runs over midnight
+        return minute >= start or minute < end
+
+    def take(self, n:int):
+        if not self.active():
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if 0 < wait:
+            time.sleep(wait)
+
+
+def parseBwlimit(value:str):
+    # RATE[@HH:MM-HH:MM], with the rate in bytes a second - K, M and
+    # G suffixes work as for sizes
+    window = None
+    if '@' in value:
+        value, times = value.split('@', 1)
+        start, end = times.split('-', 1)
+        window = []
+        for t in (start, end):
+            hours, minutes = t.strip().split(':', 1)
+            if not (0 <= int(hours) < 24 and 0 <= int(minutes) < 60):
+                raise ValueError(t)
+            window.append(int(hours) * 60 + int(minutes))
+        window = tuple(window)
+    rate = parseSize(value)
+    if rate < 1:
+        raise ValueError(value)
+    return rate, window
+
+
+# blocks with the same limit share a bucket, so that --bwlimit
+# caps the whole run
+tokenBuckets = {}
+tokenBucketsLock = threading.Lock()
+
+def tokenBucket(spec:str):
+    with tokenBucketsLock:
+        if spec not in tokenBuckets:
+            rate, window = parseBwlimit(spec)
+            tokenBuckets[spec] = TokenBucket(rate, window)
+        return tokenBuckets[spec]
+
+
+def parseSize(value:str):
+    # sizes may be given as a plain number of bytes or
+    # with a K, M or G suffix
+    value = value.strip().upper()
+    if value.endswith("B"):
+        value = value[:-1]
+    scale = 1
+    if value and value[-1] in "KMG":
+        scale = 1024 ** ("KMG".index(value[-1]) + 1)
+        value = value[:-1]
+    return int(float(value) * scale)
+
+
+# default size of the buffer used when the data has to be copied
+# through user space
+COPY_BUFSIZE = 1024 * 1024
+# an interrupted copy of a file at least this large is kept
+# and resumed on the next attempt
+RESUME_SIZE = 64 * 1024 * 1024
+# amount of data compared to check a partial file can be resumed
+RESUME_CHECK = 64 * 1024
+
+
+def makeDirs(path:str):
+    # like os.makedirs, but without a level of recursion
+    # for each missing directory
+    missing = []
+    while path and not os.path.isdir(path):
+        missing.append(path)
+        parent = os.path.dirname(path)
+        if parent == path or not parent:
+            break
+        path = parent
+    for d in reversed(missing):
+        try:
+            os.mkdir(d)
+        except FileExistsError:
+            pass
+
+
+def partialName(dest:str):
+    head, tail = os.path.split(dest)
+    return os.path.join(head, "." + tail + ".partial")
+
+
+def resumeOffset(fsrc, srcstat, partial:str):
+    # a partial copy can be picked up where it stopped if it was
+    # written after the source was last modified and its tail
+    # still matches the source
+    try:
+        pst = os.stat(partial)
+    except OSError:
+        return 0
+    if pst.st_size == 0 or pst.st_size > srcstat.st_size:
+        return 0
+    if pst.st_mtime_ns < srcstat.st_mtime_ns:
+        return 0
+    check = min(RESUME_CHECK, pst.st_size)
+    with open(partial, "rb") as f:
+        f.seek(pst.st_size - check)
+        tail = f.read(check)
+    fsrc.seek(pst.st_size - check)
+    if fsrc.read(check) != tail:
+        return 0
+    return pst.st_size
+
+
+def transferData(fsrc, fdst, offset:int, size:int, bufsize:int, bucket=None):
+    # let the kernel move the data if it can, otherwise copy
+    # it through a buffer of the requested size. If given, bucket
+    # limits the rate the data moves at
+    infd = fsrc.fileno()
+    outfd = fdst.fileno()
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                n = os.copy_file_range(infd, outfd, min(bufsize, size - offset),
+                                       offset, offset)
+                if n == 0:
+                    break
+                offset += n
+                if bucket is not None:
+                    bucket.take(n)
+            return offset
+        except OSError as err:
+            # not supported between these filesystems
+            if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                 errno.EOPNOTSUPP, errno.EBADF):
+                raise
+    if sys.platform.startswith("linux"):
+        try:
+            fdst.seek(offset)
+            while offset < size:
+                n = os.sendfile(outfd, infd, offset, min(bufsize, size - offset))
+                if n == 0:
+                    break
+                offset += n
+                if bucket is not None:
+                    bucket.take(n)
+            return offset
+        except OSError as err:
+            if err.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    while True:
+        n = fsrc.readinto(buf)
+        if not n:
+            break
+        fdst.write(view[:n])
+        offset += n
+        if bucket is not None:
+            bucket.take(n)
+    return offset
+
+
+def copyData(p:dict, source:str, dest:str):
+    # the data goes to a temporary file that is renamed over dest
+    # once it is complete, so an interrupted copy never leaves a
+    # truncated file that looks up to date
+    if "bufsize" in p:
+        bufsize = p["bufsize"]
+    else:
+        bufsize = COPY_BUFSIZE
+    bucket = None
+    if "bandwidth" in p:
+        bucket = p["bandwidth"]
+    try:
+        same = os.path.samefile(source, dest)
+    except OSError:
+        # dest doesn't exist
+        same = False
+    if same:
+        raise shutil.SameFileError(source + " and " + dest + " are the same file")
+    partial = partialName(dest)
+    with open(source, "rb", buffering=0) as fsrc:
+        srcstat = os.fstat(fsrc.fileno())
+        offset = 0
+        if srcstat.st_size >= RESUME_SIZE:
+            offset = resumeOffset(fsrc, srcstat, partial)
+        if 0 < offset:
+            p["log"].info("Resuming copy of %s at byte %s", source, offset)
+            mode = "r+b"
+        else:
+            mode = "wb"
+        try:
+            fdst = open(partial, mode, buffering=0)
+        except FileNotFoundError:
+            # the directory we are copying into isn't there yet
+            makeDirs(os.path.dirname(dest))
+            fdst = open(partial, mode, buffering=0)
+        try:
+            with fdst:
+                offset = transferData(fsrc, fdst, offset, srcstat.st_size, bufsize, bucket)
+                fdst.truncate(offset)
+            shutil.copystat(source, partial)
+            os.replace(partial, dest)
+            return offset
+        except BaseException:
+            # keep what we have of a large file so that the
+            # next attempt can pick up from there
+            if srcstat.st_size < RESUME_SIZE:
+                try:
+                    os.unlink(partial)
+                except OSError:
+                    pass
+            raise
+
+
+DELTA_BLOCK = 1024 * 1024
+DELTA_MIN = 4 * DELTA_BLOCK
+SIGNATURE_MAGIC = b"BSIG1\n"
+SIGNATURE_HEADER = struct.Struct("<QqI")
+SIGNATURE_HASH = 16
+
+def signatureName(dest:str):
+    head, tail = os.path.split(dest)
+    return os.path.join(head, "." + tail + ".blocksig")
+
+
+def blockHash(data):
+    return hashlib.blake2b(data, digest_size=SIGNATURE_HASH).digest()
+
+
+def readSignature(dest:str):
+    # the block hashes of dest, if it still is the file they were
+    # taken from. A file hard-linked from elsewhere - a snapshot or
+    # the content store - can't be changed in place at all
+    try:
+        st = os.stat(dest)
+        with open(signatureName(dest), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if st.st_nlink != 1 or not data.startswith(SIGNATURE_MAGIC):
+        return None
+    data = data[len(SIGNATURE_MAGIC):]
+    size, mtime_ns, blocksize = SIGNATURE_HEADER.unpack_from(data)
+    if size != st.st_size or mtime_ns != st.st_mtime_ns or blocksize != DELTA_BLOCK:
+        return None
+    data = data[SIGNATURE_HEADER.size:]
+    return [data[i:i + SIGNATURE_HASH] for i in range(0, len(data), SIGNATURE_HASH)]
+
+
+def writeSignature(dest:str, hashes:list):
+    st = os.stat(dest)
+    path = signatureName(dest)
+    partial = partialName(path)
+    with open(partial, "wb") as f:
+        f.write(SIGNATURE_MAGIC)
+        f.write(SIGNATURE_HEADER.pack(st.st_size, st.st_mtime_ns, DELTA_BLOCK))
+        f.write(b"".join(hashes))
+    os.replace(partial, path)
+
+
+def dropSignature(dest:str):
+    try:
+        os.unlink(signatureName(dest))
+    except FileNotFoundError:
+        pass
+
+
+def sourceHashes(source:str):
+    hashes = []
+    with open(source, "rb") as f:
+        while True:
+            block = f.read(DELTA_BLOCK)
+            if not block:
+                break
+            hashes.append(blockHash(block))
+    return hashes
+
+
+def deltaData(p:dict, source:str, dest:str):
+    # bring a large dest up to date by rewriting only the blocks that
+    # differ from the source, going by the signature kept beside it.
+    # Falls back to a full copy when there is no usable signature or
+    # too much has changed for it to be worth it. Returns the bytes
+    # copied
+    st = os.stat(source)
+    if st.st_size < DELTA_MIN:
+        return copyData(p, source, dest)
+    signature = readSignature(dest)
+    if signature is None:
+        hashes = None
+    else:
+        hashes = sourceHashes(source)
+        changed = [i for i, h in enumerate(hashes) if i >= len(signature) or h != signature[i]]
+        if len(changed) * 2 <= len(hashes):
+            # dest is about to stop matching the signature
+            dropSignature(dest)
+            # until it is finished dest is neither the old file nor the
+            # new one - make it look older than any source, so that a
+            # run that dies part way leaves it to be copied again
+            os.utime(dest, ns=(0, 0))
+            n = 0
+            try:
+                with open(source, "rb") as fsrc, open(dest, "r+b") as fdst:
+                    for i in changed:
+                        fsrc.seek(i * DELTA_BLOCK)
+                        block = fsrc.read(DELTA_BLOCK)
+                        fdst.seek(i * DELTA_BLOCK)
+                        fdst.write(block)
+                        n += len(block)
+                        if "bandwidth" in p:
+                            p["bandwidth"].take(len(block))
+                    fdst.truncate(st.st_size)
+                shutil.copystat(source, dest)
+            except BaseException:
+                # the writes may have changed the mtime again
+                try:
+                    os.unlink(dest)
+                except OSError:
+                    pass
+                raise
+            p["stats"].add("delta")
+            p["stats"].add("deltasaved", st.st_size - n)
+            p["log"].debug("Delta: %s of %s blocks of %s rewritten", len(changed), len(hashes), dest)
+            signFile(p, source, dest, st, hashes)
+            return n
+        p["log"].debug("Delta: %s of %s blocks of %s changed - copying all of it", len(changed), len(hashes), dest)
+    dropSignature(dest)
+    n = copyData(p, source, dest)
+    signFile(p, source, dest, st, hashes)
+    return n
+
+
+def signFile(p:dict, source:str, dest:str, st, hashes:list):
+    # only sign dest if the source didn't change while it was being
+    # copied - otherwise the next run copies all of it again
+    try:
+        if hashes is None:
+            hashes = sourceHashes(source)
+        now = os.stat(source)
+        if now.st_size == st.st_size and now.st_mtime_ns == st.st_mtime_ns:
+            writeSignature(dest, hashes)
+    except OSError as err:
+        p["log"].debug("Could not write the signature of %s: %s", dest, err)
+
+
+def copyFile(p:dict, source:str, dest:str):
+    start = time.monotonic()
+    try:
+        if "contentStore" in p:
+            n = storeData(p, source, dest)
+        elif "delta" in p and p["delta"]:
+            n = deltaData(p, source, dest)
+        else:
+            n = copyData(p, source, dest)
+        p["stats"].add("copied")
+        p["stats"].add("bytes", n)
+        p["stats"].time("copy", time.monotonic() - start)
+        if "profile" in p:
+            p["profile"].copied(os.path.dirname(source), time.monotonic() - start)
+        return True
+    # If source and destination are same
+    except shutil.SameFileError:
+        p["log"].error("Source and destination represents the same file: %s", source)
+        pass
+
+    # If there is any permission issue
+    except PermissionError:
+        p["log"].error("Permission denied for: %s to %s", source, dest)
+        pass
+
+    except (IOError, OSError) as err:
+        p["log"].debug("Error backing up: %s Error: %s", source, err)
+        pass
+
+    except Exception:
+        p["log"].error("Unrecognized error: %s", source)
+        pass
+
+    p["stats"].add("errors")
+    p["stats"].time("copy", time.monotonic() - start)
+    return False
+
+
+def runCopy(p:dict, source:str, dest:str, done):
+    # copies still waiting for a worker are dropped on Ctrl-C
+    if stopping.is_set():
+        return
+    ok = copyFile(p, source, dest)
+    if done is not None:
+        done(ok)
+
+
+def submitCopy(p:dict, source:str, dest:str, what:str, done=None, rel:str=None, st=None):
+    # what says why the copy is being made, for the log
+    p["stats"].add("selected")
+    if "manifest" in p:
+        # just planning - record the copy for later
+        p["log"].debug("%s: %s to %s", what, source, dest)
+        p["manifest"].copy(p, source, dest, rel, st)
+        return
+    if "dryrun" in p and p["dryrun"]:
+        p["log"].info("%s: %s to %s", what, source, dest)
+        return
+    p["log"].debug("%s: %s to %s", what, source, dest)
+    # hand the copy to the worker pool if we have one, otherwise
+    # just do it here. If given, done is called with the outcome
+    # once the copy has finished
+    if "pool" in p and p["pool"] is not None:
+        p["pool"].submit(runCopy, p, source, dest, done)
+    else:
+        runCopy(p, source, dest, done)
+
+
+def linkFile(p:dict, target:str, dest:str):
+    # hard-link an unchanged file from the previous snapshot into the
+    # new one. Returns False if the file has to be copied instead
+    if "dryrun" in p and p["dryrun"]:
+        p["log"].info("Linking: %s to %s", target, dest)
+        return True
+    p["log"].debug("Linking: %s to %s", target, dest)
+    try:
+        os.link(target, dest)
+    except FileExistsError:
+        # linked by a run that got interrupted
+        pass
+    except OSError as err:
+        # not all filesystems can do it - say so once
+        if "linkFailed" not in p:
+            p["linkFailed"] = True
+            p["log"].warning("Could not hard-link %s into the snapshot (%s) - copying the files that can't be linked", target, err)
+        return False
+    p["stats"].add("linked")
+    return True
+
+
+def makeDest(p:dict, destpath:str):
+    try:
+        if "manifest" in p:
+            p["log"].debug("Making dest path: %s", destpath)
+            p["manifest"].mkdir(p, destpath)
+        elif "dryrun" in p and p["dryrun"]:
+            p["log"].info("Making dest path: %s", destpath)
+        else:
+            p["log"].debug("Making dest path: %s", destpath)
+            p["stats"].add("mkdir")
+            makeDirs(destpath)
+    except OSError:
+        # directory already exists
+        pass
+
+
+class Stats:
+    """Thread-safe counters and timers collected while processing a
+    config block, along with the directories that took the longest"""
+
+    SLOWEST = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.timers = {}
+        # a min-heap of (seconds, path), so the fastest of the
+        # slowest directories is the one that gets pushed out
+        self.slow = []
+
+    def add(self, key:str, n:int=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + n
+
+    def get(self, key:str):
+        with self.lock:
+            return self.counts.get(key, 0)
+
+    def time(self, key:str, seconds:float):
+        with self.lock:
+            self.timers[key] = self.timers.get(key, 0.0) + seconds
+
+    def dirTime(self, path:str, seconds:float):
+        with self.lock:
+            if len(self.slow) < self.SLOWEST:
+                heapq.heappush(self.slow, (seconds, path))
+            elif seconds > self.slow[0][0]:
+                heapq.heapreplace(self.slow, (seconds, path))
+
+    def slowest(self):
+        with self.lock:
+            return sorted(self.slow, reverse=True)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts), dict(self.timers)
+
+
+class DirProfile:
+    """Where a config block's time went, directory by directory - the
+    time spent scanning each source directory, deciding what to do
+    with its files and copying them, and how many files it held"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = {}
+
+    def entry(self, path:str):
+        # called with the lock held
+        path = os.path.normpath(path)
+        if path not in self.dirs:
+            self.dirs[path] = [0.0, 0.0, 0.0, 0]
+        return self.dirs[path]
+
+    def walked(self, path:str, scan:float, decide:float, files:int):
+        with self.lock:
+            e = self.entry(path)
+            e[0] += scan
+            e[1] += decide
+            e[3] += files
+
+    def copied(self, path:str, seconds:float):
+        # called from the copy workers
+        with self.lock:
+            self.entry(path)[2] += seconds
+
+    def subtrees(self, root:str):
+        # the totals for each directory along with everything below it
+        root = os.path.normpath(root)
+        totals = {}
+        with self.lock:
+            for path, e in self.dirs.items():
+                d = path
+                while True:
+                    if d not in totals:
+                        totals[d] = [0.0, 0.0, 0.0, 0]
+                    t = totals[d]
+                    for i in range(4):
+                        t[i] += e[i]
+                    if d == root:
+                        break
+                    parent = os.path.dirname(d)
+                    if parent == d:
+                        break
+                    d = parent
+        return totals
+
+
+class Sampler:
+    """Looks at what every thread is doing at regular intervals. Unlike
+    cProfile, which only follows the thread that started it, this sees
+    the scan and copy workers too"""
+
+    def __init__(self, interval:float=0.005):
+        self.interval = interval
+        self.samples = {}
+        self.count = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.done.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                # charge the sample to the innermost line of ours, so
+                # time in the library shows up where it was called from.
+                # Idle workers and the log writer aren't running any
+                while frame is not None and frame.f_code.co_filename != __file__:
+                    frame = frame.f_back
+                if frame is None:
+                    continue
+                key = (frame.f_lineno, frame.f_code.co_name)
+                self.samples[key] = self.samples.get(key, 0) + 1
+                self.count += 1
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+
+    def report(self, top:int):
+        print("Lines the threads were found at, over {} samples:".format(self.count))
+        for key, n in sorted(self.samples.items(), key=lambda i: i[1], reverse=True)[:top]:
+            print("  {:>6.1f}%  line {} ({})".format(100.0 * n / max(self.count, 1), *key))
+
+
+def stemIndex(names):
+    # every name with one or more of its extensions taken off, so
+    # that "a.tar.gz" is found under both "a" and "a.tar"
+    stems = set()
+    for name in names:
+        dot = name.find('.', 1)
+        while 0 < dot:
+            stems.add(name[:dot])
+            dot = name.find('.', dot + 1)
+    return stems
+
+
+class TargetDir:
+    """The entries of a target directory, listed once with os.scandir
+    the first time they are needed. Each entry is stat'd at most once,
+    and only if a comparison actually asks for it"""
+
+    def __init__(self, p:dict, path:str):
+        self.p = p
+        self.path = path
+        self.entries = None
+        self.stats = {}
+        self.stems = None
+
+    def load(self):
+        self.entries = {}
+        self.p["stats"].add("scandir")
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    self.entries[entry.name] = entry
+        except OSError:
+            # the directory doesn't exist (yet)
+            pass
+
+    def stat(self, name:str):
+        if self.entries is None:
+            self.load()
+        if name in self.stats:
+            return self.stats[name]
+        st = None
+        entry = self.entries.get(name)
+        if entry is not None:
+            self.p["stats"].add("stat")
+            try:
+                st = entry.stat()
+            except OSError:
+                # dangling link or it vanished - treat it as missing
+                pass
+        self.stats[name] = st
+        return st
+
+    def hasStem(self, stem:str):
+        # is there an entry named stem.<something>?
+        if self.stems is None:
+            if self.entries is None:
+                self.load()
+            self.stems = stemIndex(self.entries)
+        return stem in self.stems
+
+    def snapshot(self, skip):
+        # stat everything in the directory so it can be recorded
+        # in the snapshot index
+        if self.entries is None:
+            self.load()
+        entries = {}
+        for name in self.entries:
+            if name in skip:
+                continue
+            st = self.stat(name)
+            if st is not None:
+                entries[name] = st
+        return entries
+
+
+IndexStat = namedtuple("IndexStat", ["st_size", "st_mtime_ns"])
+
+
+class SnapshotIndex:
+    """On-disk record of the target tree of each config block as it
+    stood at the end of its last successful run, keyed by TITLE. Paths
+    are relative to the top of the tree. A row in the dirs table means
+    the contents of that target directory are recorded in the files
+    table, and also holds the mtime the source directory had when it
+    was last processed.
+
+    Changes are collected in temporary tables private to this
+    connection and only moved into the index, in one short
+    transaction, once the whole block has been processed. An
+    interrupted or dry run therefore leaves the previous snapshot in
+    place, and blocks sharing an index file don't lock each other
+    out while they run"""
+
+    def __init__(self, path:str, title:str):
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (title TEXT, path TEXT, "
+                        "mtime_ns INTEGER, PRIMARY KEY (title, path))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (title TEXT, dir TEXT, "
+                        "name TEXT, size INTEGER, mtime_ns INTEGER, "
+                        "PRIMARY KEY (title, dir, name))")
+        self.db.execute("CREATE TEMP TABLE newdirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        self.db.execute("CREATE TEMP TABLE newfiles (dir TEXT, name TEXT, size INTEGER, "
+                        "mtime_ns INTEGER, PRIMARY KEY (dir, name))")
+        self.title = title
+        # copy workers report their results here, and the walker
+        # moves them into the database
+        self.lock = threading.Lock()
+        self.pending = []
+        self.failed = set()
+
+    def dirMtime(self, rel:str):
+        row = self.db.execute("SELECT mtime_ns FROM dirs WHERE title = ? AND path = ?",
+                              (self.title, rel)).fetchone()
+        if row is None:
+            return None
+        return row[0]
 
-def checkmatch(src:str, pattern:str):
-    if src == pattern:
+    def files(self, rel:str):
+        entries = {}
+        for name, size, mtime_ns in self.db.execute(
+                "SELECT name, size, mtime_ns FROM files WHERE title = ? AND dir = ?",
+                (self.title, rel)):
+            entries[name] = IndexStat(size, mtime_ns)
+        return entries
+
+    def recordDir(self, rel:str, mtime_ns:int, entries:dict):
+        self.db.execute("INSERT OR REPLACE INTO newdirs VALUES (?, ?)", (rel, mtime_ns))
+        self.db.executemany("INSERT OR REPLACE INTO newfiles VALUES (?, ?, ?, ?)",
+                            [(rel, name, st.st_size, st.st_mtime_ns)
+                             for name, st in entries.items()])
+
+    def copied(self, rel:str, name:str, st, ok:bool):
+        # called from the copy workers
+        with self.lock:
+            self.pending.append((rel, name, st, ok))
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        for rel, name, st, ok in pending:
+            if ok:
+                self.db.execute("INSERT OR REPLACE INTO newfiles VALUES (?, ?, ?, ?)",
+                                (rel, name, st.st_size, st.st_mtime_ns))
+            else:
+                self.failed.add(rel)
+
+    def commit(self, clear:bool=False):
+        self.flush()
+        # make sure the next run looks at directories
+        # with failed copies again
+        self.db.executemany("UPDATE newdirs SET mtime_ns = 0 WHERE path = ?",
+                            [(rel,) for rel in self.failed])
+        self.db.execute("BEGIN IMMEDIATE")
+        if clear:
+            self.db.execute("DELETE FROM dirs WHERE title = ?", (self.title,))
+            self.db.execute("DELETE FROM files WHERE title = ?", (self.title,))
+        self.db.execute("INSERT OR REPLACE INTO dirs SELECT ?, path, mtime_ns FROM newdirs",
+                        (self.title,))
+        self.db.execute("INSERT OR REPLACE INTO files SELECT ?, dir, name, size, mtime_ns "
+                        "FROM newfiles", (self.title,))
+        self.db.execute("COMMIT")
+
+    def close(self):
+        self.db.close()
+
+
+class IndexedDir:
+    """Stand-in for TargetDir whose entries come from the snapshot
+    index instead of the filesystem"""
+
+    def __init__(self, entries:dict):
+        self.entries = entries
+        self.stems = None
+
+    def stat(self, name:str):
+        return self.entries.get(name)
+
+    def hasStem(self, stem:str):
+        if self.stems is None:
+            self.stems = stemIndex(self.entries)
+        return stem in self.stems
+
+
+PACK_INDEX = ".backup-packs.db"
+PACK_LIMIT = 64 * 1024 * 1024
+
+class PackIndex:
+    """Where each packed file is - which pack in its DEST directory
+    holds it, and the offset of its data in there. The database is kept
+    at the top of the DEST tree. A file packed again on a later run goes
+    into a new pack, and its entry moves to point there. Dry and planning
+    runs open it read-only, to see what is packed without packing more"""
+
+    def __init__(self, root:str, readonly:bool=False):
+        self.root = root
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        path = os.path.join(root, PACK_INDEX)
+        if readonly:
+            self.db = sqlite3.connect("file:" + urllib.parse.quote(path) + "?mode=ro", uri=True,
+                                      timeout=60, isolation_level=None, check_same_thread=False)
+            return
+        makeDirs(root)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        self.db.execute("CREATE TABLE IF NOT EXISTS packed (dir TEXT, name TEXT, pack TEXT, "
+                        "offset INTEGER, size INTEGER, mtime_ns INTEGER, mode INTEGER, "
+                        "PRIMARY KEY (dir, name))")
+
+    def files(self, rel:str):
+        with self.lock:
+            rows = self.db.execute("SELECT name, size, mtime_ns FROM packed WHERE dir = ?",
+                                   (rel,)).fetchall()
+        return {name: IndexStat(size, mtime_ns) for name, size, mtime_ns in rows}
+
+    def record(self, rel:str, pack:str, members:list):
+        # members holds a (name, offset, size, mtime_ns, mode) for
+        # each file in the pack
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO packed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(rel, name, pack) + tuple(m) for name, *m in members])
+            self.db.execute("COMMIT")
+
+    def drop(self, rel:str, name:str):
+        # the file is being copied normally from now on
+        with self.lock:
+            self.db.execute("DELETE FROM packed WHERE dir = ? AND name = ?", (rel, name))
+
+    def packs(self, rel:str):
+        # the packs in a directory that still hold a live file
+        with self.lock:
+            rows = self.db.execute("SELECT DISTINCT pack FROM packed WHERE dir = ?",
+                                   (rel,)).fetchall()
+        return {pack for pack, in rows}
+
+    def close(self):
+        self.db.close()
+
+
+class PackedDir:
+    """A DEST directory as seen with its packed files - these look
+    just like the files that are really there"""
+
+    def __init__(self, inner, packed:dict):
+        self.inner = inner
+        self.packed = packed
+        self.stems = None
+
+    def stat(self, name:str):
+        st = self.inner.stat(name)
+        if st is None:
+            st = self.packed.get(name)
+        return st
+
+    def isPacked(self, name:str):
+        return name in self.packed
+
+    def hasStem(self, stem:str):
+        if self.inner.hasStem(stem):
+            return True
+        if self.stems is None:
+            self.stems = stemIndex(self.packed)
+        return stem in self.stems
+
+    def snapshot(self, skip):
+        return self.inner.snapshot(skip)
+
+
+packPattern = re.compile(r"^\.pack-.+\.tar$")
+packCount = 0
+packCountLock = threading.Lock()
+
+def packName():
+    # the index points into packs by offset, so a pack must never be
+    # written over - the time alone isn't enough to tell apart two
+    # runs, or two --watch passes, in the same second
+    global packCount
+    with packCountLock:
+        packCount += 1
+        n = packCount
+    return ".pack-" + time.strftime("%Y%m%d%H%M%S") + "-" + str(os.getpid()) + "-" + str(n) + ".tar"
+
+
+def prunePacks(p:dict, rel:str, destpath:str):
+    # remove the packs whose files have all been packed again or
+    # gone back to being copied one by one
+    live = p["packIndex"].packs(rel)
+    try:
+        names = os.listdir(destpath)
+    except FileNotFoundError:
+        return
+    except OSError as err:
+        p["log"].error("Could not list %s: %s", destpath, err)
+        return
+    for name in names:
+        if packPattern.match(name) and name not in live:
+            try:
+                os.unlink(os.path.join(destpath, name))
+                p["stats"].add("pruned")
+                p["log"].debug("Removed unused pack %s", os.path.join(destpath, name))
+            except OSError as err:
+                p["log"].error("Could not remove %s: %s", os.path.join(destpath, name), err)
+
+
+def packFiles(p:dict, rel:str, destpath:str, files:list):
+    # write a directory's small files into packs, starting a new pack
+    # whenever one gets to PACK_LIMIT. files holds (name, source,
+    # dest, done) for each file
+    recorded = False
+    while files and not stopping.is_set():
+        pack = packName()
+        path = os.path.join(destpath, pack)
+        partial = partialName(path)
+        members = []
+        finished = []
+        try:
+            try:
+                tar = tarfile.open(partial, "x", format=tarfile.PAX_FORMAT)
+            except FileNotFoundError:
+                makeDirs(destpath)
+                tar = tarfile.open(partial, "x", format=tarfile.PAX_FORMAT)
+            with tar:
+                while files and tar.offset < PACK_LIMIT:
+                    name, source, dest, done = files.pop(0)
+                    try:
+                        with open(source, "rb") as f:
+                            st = os.fstat(f.fileno())
+                            info = tar.gettarinfo(arcname=name, fileobj=f)
+                            tar.addfile(info, f)
+                        if "bandwidth" in p:
+                            p["bandwidth"].take(st.st_size)
+                    except OSError as err:
+                        p["log"].error("Error packing: %s Error: %s", source, err)
+                        p["stats"].add("errors")
+                        if done is not None:
+                            done(False)
+                        continue
+                    # the data ends the pack, padded out to a block
+                    offset = tar.offset - (st.st_size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+                    members.append((name, offset, st.st_size, st.st_mtime_ns, st.st_mode & 0o7777))
+                    finished.append((dest, done, st.st_size))
+            if os.path.exists(path):
+                raise FileExistsError(errno.EEXIST, "a pack of that name is already there", path)
+            os.replace(partial, path)
+            p["packIndex"].record(rel, pack, members)
+            recorded = True
+        except (OSError, sqlite3.Error) as err:
+            p["log"].error("Error writing pack %s Error: %s", path, err)
+            try:
+                os.unlink(partial)
+            except OSError:
+                pass
+            for dest, done, size in finished:
+                p["stats"].add("errors")
+                if done is not None:
+                    done(False)
+            continue
+        p["log"].debug("Packed %s files into %s", len(members), path)
+        for dest, done, size in finished:
+            p["stats"].add("packed")
+            p["stats"].add("bytes", size)
+            # a copy made while the file was bigger is out of date now
+            try:
+                os.unlink(dest)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                p["log"].error("Could not remove %s: %s", dest, err)
+            if done is not None:
+                done(True)
+    if recorded:
+        prunePacks(p, rel, destpath)
+
+
+def submitPack(p:dict, rel:str, destpath:str, files:list):
+    if "pool" in p:
+        p["pool"].submit(packFiles, p, rel, destpath, files)
+    else:
+        packFiles(p, rel, destpath, files)
+
+
+def findPackIndex(path:str):
+    # the top of the DEST tree a file was backed up into
+    d = os.path.dirname(os.path.abspath(path))
+    while not os.path.exists(os.path.join(d, PACK_INDEX)):
+        parent = os.path.dirname(d)
+        if parent == d:
+            return None
+        d = parent
+    return d
+
+
+def restorePacked(path:str, out:str):
+    # get a single packed file back out of its pack
+    root = findPackIndex(path)
+    if root is None:
+        print("No packed files found above", path)
+        return False
+    rel = os.path.relpath(os.path.dirname(os.path.abspath(path)), root)
+    if rel == ".":
+        rel = ""
+    db = sqlite3.connect(os.path.join(root, PACK_INDEX))
+    row = db.execute("SELECT pack, offset, size, mtime_ns, mode FROM packed WHERE dir = ? AND name = ?",
+                     (rel, os.path.basename(path))).fetchone()
+    db.close()
+    if row is None:
+        print(path, "is not in a pack")
+        return False
+    pack, offset, size, mtime_ns, mode = row
+    partial = partialName(out)
+    try:
+        with open(os.path.join(root, rel, pack), "rb") as fsrc, open(partial, "wb") as fdst:
+            fsrc.seek(offset)
+            while 0 < size:
+                buf = fsrc.read(min(size, COPY_BUFSIZE))
+                if not buf:
+                    raise IOError("pack " + pack + " is truncated")
+                fdst.write(buf)
+                size -= len(buf)
+        os.chmod(partial, mode)
+        os.utime(partial, ns=(mtime_ns, mtime_ns))
+        os.replace(partial, out)
+    except OSError as err:
+        print("Could not restore", path, "from", pack + ":", err)
+        return False
+    print("Restored", path, "to", out)
+    return True
+
+
+class DigestCache:
+    """Content digests of files, keyed by path together with the size
+    and mtime the file had when it was hashed, so that a file is only
+    read again once it has changed. The digests are kept in the
+    snapshot index database if the block has one, otherwise only for
+    the length of the run"""
+
+    def __init__(self, path:str=None):
+        self.lock = threading.Lock()
+        self.memory = {}
+        self.pending = []
+        self.db = None
+        if path is not None:
+            # the copy workers look digests up too
+            self.db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                      check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, "
+                            "size INTEGER, mtime_ns INTEGER, digest BLOB)")
+
+    def get(self, path:str, st):
+        # may be called from the copy workers
+        with self.lock:
+            if path in self.memory:
+                size, mtime_ns, digest = self.memory[path]
+                if size == st.st_size and mtime_ns == st.st_mtime_ns:
+                    return digest
+            if self.db is not None:
+                row = self.db.execute("SELECT size, mtime_ns, digest FROM digests WHERE path = ?",
+                                      (path,)).fetchone()
+                if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+                    return row[2]
+        return None
+
+    def put(self, path:str, st, digest:bytes):
+        # may be called from the copy workers
+        with self.lock:
+            self.memory[path] = (st.st_size, st.st_mtime_ns, digest)
+            if self.db is not None:
+                self.pending.append((path, st.st_size, st.st_mtime_ns, digest))
+
+    def flush(self):
+        if self.db is None:
+            return
+        with self.lock:
+            if self.pending:
+                self.db.execute("BEGIN")
+                self.db.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)", self.pending)
+                self.db.execute("COMMIT")
+            self.pending = []
+            # whatever was waiting is in the database now
+            self.memory = {}
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+
+
+def fileDigest(p:dict, path:str, st):
+    # BLAKE2b of the file's contents, from the cache if the
+    # file hasn't changed since it was last hashed
+    digest = p["digests"].get(path, st)
+    if digest is not None:
+        return digest
+    if "bufsize" in p:
+        bufsize = p["bufsize"]
+    else:
+        bufsize = COPY_BUFSIZE
+    h = hashlib.blake2b(digest_size=32)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    p["stats"].add("hashed")
+    p["stats"].add("hashbytes", st.st_size)
+    digest = h.digest()
+    p["digests"].put(path, st, digest)
+    return digest
+
+
+compareModes = ["mtime", "size", "mtime+size", "hash"]
+
+def isChanged(p:dict, source:str, srcstat, target:str, tgtstat, what:str):
+    # decide whether source needs to be copied over the existing
+    # target, which is either the TARGET or the DEST file
+    modtime = srcstat.st_mtime_ns
+    backuptime = tgtstat.st_mtime_ns
+    if what == "Target":
+        label = "Comptime"
+    else:
+        label = "Desttime"
+    p["log"].debug("Source: %s Modtime: %.2f %s: %.2f", source, modtime / 1e9, label, backuptime / 1e9)
+
+    if "compare" in p:
+        mode = p["compare"]
+    else:
+        mode = "mtime"
+
+    if mode == "mtime":
+        if modtime < backuptime:
+            p["log"].debug("%s %s is newer - ignoring", what, target)
+            return False
+        if modtime == backuptime:
+            p["log"].debug("%s and source are of same age - ignoring", what)
+            return False
+        return True
+
+    if srcstat.st_size != tgtstat.st_size:
+        return True
+    if mode == "size":
+        p["log"].debug("%s and source are of same size - ignoring", what)
+        return False
+    if modtime == backuptime:
+        p["log"].debug("%s and source are of same size and age - ignoring", what)
+        return False
+    if mode == "mtime+size":
         return True
 
-    if '*' not in pattern:
-        return False
+    # same size but different times - see if the contents differ
+    try:
+        same = fileDigest(p, source, srcstat) == fileDigest(p, target, tgtstat)
+    except OSError as err:
+        p["log"].error("Could not compare %s to %s: %s", source, target, err)
+        return True
+    if same:
+        p["log"].debug("%s and source have the same contents - ignoring", what)
+        return False
+    return True
+
+
+def sourceStat(p:dict, entry, cache:dict):
+    # the stat of a source entry is shared by all the
+    # config blocks looking at it
+    if entry.name in cache:
+        return cache[entry.name]
+    p["stats"].add("stat")
+    try:
+        st = entry.stat()
+    except OSError as err:
+        p["log"].error("Source %s could not be accessed: %s", entry.path, err)
+        st = None
+    cache[entry.name] = st
+    return st
+
+
+class Journal:
+    """Append-only record of the work a config block has finished, so
+    that a run that gets interrupted can pick up where it stopped. A
+    "copy" record is written as each copy completes, and a "dir" record
+    once every file in a directory has been dealt with. Records are
+    fsync'd in batches, and the journal is removed when the block
+    completes, so finding one at startup means the last run was cut short"""
+
+    # sync after this many records or this many seconds
+    BATCH = 256
+    INTERVAL = 5.0
+
+    def __init__(self, path:str):
+        self.path = path
+        self.files = {}
+        self.dirs = set()
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # the last record may only be partly there
+                        break
+                    if rec["op"] == "copy":
+                        self.files[rec["path"]] = (rec["size"], rec["mtime_ns"])
+                    elif rec["op"] == "dir":
+                        self.dirs.add(rec["path"])
+        except FileNotFoundError:
+            pass
+        self.f = open(path, "a")
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.lastsync = time.monotonic()
+        # copies still running in each directory, directories whose
+        # files have all been looked at, and directories with a copy
+        # that failed
+        self.outstanding = {}
+        self.finished = set()
+        self.failed = set()
+
+    def resumed(self):
+        return bool(self.files) or bool(self.dirs)
+
+    def dirDone(self, rel:str):
+        return rel in self.dirs
+
+    def fileDone(self, path:str, st):
+        return self.files.get(path) == (st.st_size, st.st_mtime_ns)
+
+    def write(self, rec:dict):
+        # called with the lock held
+        self.f.write(json.dumps(rec) + "\n")
+        self.unsynced += 1
+        if self.unsynced >= self.BATCH or time.monotonic() - self.lastsync >= self.INTERVAL:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.lastsync = time.monotonic()
+
+    def submitted(self, rel:str):
+        with self.lock:
+            self.outstanding[rel] = self.outstanding.get(rel, 0) + 1
+
+    def copied(self, rel:str, name:str, st, ok:bool):
+        # called from the copy workers
+        with self.lock:
+            self.outstanding[rel] -= 1
+            if ok:
+                self.write({"op": "copy", "path": os.path.join(rel, name),
+                            "size": st.st_size, "mtime_ns": st.st_mtime_ns})
+            else:
+                self.failed.add(rel)
+            if rel in self.finished and 0 == self.outstanding[rel]:
+                self.dirFinished(rel)
+
+    def endDir(self, rel:str):
+        with self.lock:
+            if 0 == self.outstanding.get(rel, 0):
+                self.dirFinished(rel)
+            else:
+                self.finished.add(rel)
+
+    def dirFinished(self, rel:str):
+        # called with the lock held
+        self.finished.discard(rel)
+        self.outstanding.pop(rel, None)
+        if rel not in self.failed:
+            self.write({"op": "dir", "path": rel})
+
+    def close(self, complete:bool):
+        with self.lock:
+            self.sync()
+            self.f.close()
+            if complete:
+                os.unlink(self.path)
+
+
+def journalPath(directory:str, key:str):
+    return os.path.join(directory, re.sub(r"[^A-Za-z0-9._-]", "_", key) + ".journal")
+
+
+def needSourceStat(p:dict):
+    # does anything need the stat of a file being copied?
+    for e in ["snapshotIndex", "digests", "manifest", "resumeJournal", "packIndex"]:
+        if e in p:
+            return True
+    return False
+
+
+def copyDone(p:dict, rel:str, name:str, source:str, dest:str, st):
+    # what to update once a copy has finished. Only copies into the
+    # target tree change what the index records - if DEST differs
+    # from TARGET, there is nothing to do there. A snapshot is the
+    # next run's TARGET, so its copies are recorded too
+    index = None
+    if "snapshotIndex" in p and (p["dest"] == p["target"] or "snapshotRoot" in p):
+        index = p["snapshotIndex"]
+    digests = None
+    if "digests" in p:
+        digests = p["digests"]
+    journal = None
+    if "resumeJournal" in p:
+        journal = p["resumeJournal"]
+        journal.submitted(rel)
+    if st is None or (index is None and digests is None and journal is None):
+        return None
+
+    def done(ok):
+        if journal is not None:
+            journal.copied(rel, name, st, ok)
+        if index is not None:
+            index.copied(rel, name, st, ok)
+        if ok and digests is not None:
+            # the copy has the same contents and times as the
+            # source, so it has the same digest too
+            digest = digests.get(source, st)
+            if digest is not None:
+                digests.put(dest, st, digest)
+    return done
+
+
+class ContentStore:
+    """Files kept once for each distinct content, named by the BLAKE2b
+    digest of the content, which the backup trees of any number of
+    config blocks - and machines - hard-link to. The database in the
+    store records the objects it holds, so finding out whether some
+    content is already there doesn't mean looking through the store"""
+
+    def __init__(self, path:str):
+        self.path = path
+        self.users = 0
+        self.lock = threading.Lock()
+        makeDirs(os.path.join(path, "objects"))
+        self.db = sqlite3.connect(os.path.join(path, "store.db"), timeout=60,
+                                  isolation_level=None, check_same_thread=False)
+        # the store is likely to be on a network share, where
+        # WAL doesn't work
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        self.db.execute("CREATE TABLE IF NOT EXISTS objects (digest BLOB PRIMARY KEY, size INTEGER)")
+
+    def objectPath(self, digest:bytes):
+        name = digest.hex()
+        return os.path.join(self.path, "objects", name[:2], name[2:])
+
+    def has(self, digest:bytes):
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM objects WHERE digest = ?", (digest,)).fetchone()
+        return row is not None
+
+    def add(self, digest:bytes, size:int):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO objects VALUES (?, ?)", (digest, size))
+
+    def forget(self, digest:bytes):
+        # the object has gone from the store
+        with self.lock:
+            self.db.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+
+    def close(self):
+        self.db.close()
+
+
+# stores are shared by every config block using them
+contentStores = {}
+contentStoresLock = threading.Lock()
+
+def openStore(path:str):
+    path = os.path.abspath(path)
+    with contentStoresLock:
+        if path not in contentStores:
+            contentStores[path] = ContentStore(path)
+        store = contentStores[path]
+        store.users += 1
+        return store
+
+
+def closeStore(store:ContentStore):
+    with contentStoresLock:
+        store.users -= 1
+        if 0 == store.users:
+            store.close()
+            del contentStores[store.path]
+
+
+def storeData(p:dict, source:str, dest:str):
+    # put the file in the content store, unless the same contents are
+    # there already, and link dest to it. Returns the bytes copied
+    store = p["contentStore"]
+    st = os.stat(source)
+    digest = fileDigest(p, source, st)
+    obj = store.objectPath(digest)
+    n = 0
+    known = store.has(digest)
+    try:
+        ost = os.stat(obj)
+    except FileNotFoundError:
+        ost = None
+    if ost is None:
+        # not there, or taken out of the store since it was recorded
+        if known:
+            store.forget(digest)
+        known = False
+        n = copyData(p, source, obj)
+        store.add(digest, st.st_size)
+        p["stats"].add("stored")
+        ost = os.stat(obj)
+    else:
+        if not known:
+            # objects only appear under their name once they are
+            # complete, so this came from a run that didn't get
+            # as far as recording it
+            store.add(digest, st.st_size)
+            known = True
+        p["stats"].add("dedup")
+        p["stats"].add("dedupbytes", st.st_size)
+    # the object's times are shared by every file with these
+    # contents - keep the latest of them, so that none of those
+    # files looks out of date to the next run
+    if ost.st_mtime_ns < st.st_mtime_ns:
+        os.utime(obj, ns=(ost.st_atime_ns, st.st_mtime_ns))
+    partial = partialName(dest)
+    try:
+        try:
+            os.link(obj, partial)
+        except FileExistsError:
+            os.unlink(partial)
+            os.link(obj, partial)
+        except FileNotFoundError:
+            makeDirs(os.path.dirname(dest))
+            os.link(obj, partial)
+        os.replace(partial, dest)
+    except OSError as err:
+        # the store isn't on the same filesystem as DEST, or the
+        # filesystem can't do hard links - copy it instead
+        if "linkFailed" not in p:
+            p["linkFailed"] = True
+            p["log"].warning("Could not hard-link %s to the content store (%s) - copying instead", dest, err)
+        if known:
+            n = copyData(p, source, dest)
+        else:
+            # the data has been read from the source once already
+            shutil.copyfile(obj, dest)
+            shutil.copystat(source, dest)
+            if "bandwidth" in p:
+                p["bandwidth"].take(st.st_size)
+    return n
+
+
+class DirTask:
+    """A source directory waiting to be walked, along with the config
+    blocks that want it. blocks holds a (config, included) pair for
+    each block - included is set once an INCLUDEDIR pattern has matched
+    a directory above this one. views holds, for each block, where its
+    target information comes from and whether it can skip the files
+    in this directory"""
+
+    def __init__(self, blocks:list, sourcepath:str, rel:str):
+        self.blocks = blocks
+        self.sourcepath = sourcepath
+        self.rel = rel
+        self.dirlist = None
+        self.srcmtime = 0
+        self.srcstats = {}
+        self.views = []
+        self.scantime = 0.0
+        # a walk started from a directory that changed doesn't go
+        # into its subdirectories, unless they are new as well, and
+        # doesn't trust the directory's mtime
+        self.recursive = True
+        self.changed = False
+
+
+def fileCandidates(p:dict, dirlist:list):
+    # the files in a directory this block will compare
+    # against the target
+    for entry in dirlist:
+        d = entry.name
+        if '~' == d[0] or '.' == d[0] or entry.is_dir():
+            continue
+        if "excludefileMatch" in p:
+            if p["excludefileMatch"].match(d, entry.path):
+                continue
+        elif "includefileMatch" in p:
+            if not p["includefileMatch"].match(d, entry.path):
+                continue
+        yield entry
+
+
+def prepareTask(task:DirTask):
+    # look up what the snapshot index knows about each block's target.
+    # This runs in the walker, which owns the index connections
+    for p, included in task.blocks:
+        if task.rel:
+            comppath = os.path.join(p["target"], task.rel)
+            destpath = os.path.join(p["dest"], task.rel)
+        else:
+            comppath = p["target"]
+            destpath = p["dest"]
+        view = {"indexed": False, "lastmtime": None, "quick": False, "done": False}
+        if "resumeJournal" in p and p["resumeJournal"].dirDone(task.rel):
+            # this directory was finished before the last run was
+            # interrupted - only its subdirectories need looking at
+            view["done"] = True
+            task.views.append(view)
+            continue
+        if "snapshotIndex" in p:
+            view["lastmtime"] = p["snapshotIndex"].dirMtime(task.rel)
+            if view["lastmtime"] is not None and not ("verify" in p and p["verify"]):
+                view["indexed"] = True
+        if view["indexed"]:
+            view["complist"] = IndexedDir(p["snapshotIndex"].files(task.rel))
+        else:
+            view["complist"] = TargetDir(p, comppath)
+        if destpath == comppath:
+            view["destlist"] = view["complist"]
+        else:
+            view["destlist"] = TargetDir(p, destpath)
+        if "packIndex" in p:
+            # packed files are in DEST as much as those copied there
+            packed = PackedDir(view["destlist"], p["packIndex"].files(task.rel))
+            if view["destlist"] is view["complist"]:
+                view["complist"] = packed
+            view["destlist"] = packed
+        task.views.append(view)
+
+
+def scanTask(task:DirTask):
+    # do the filesystem work for a directory - list the source, and
+    # list and stat whatever in the target the decisions are going to
+    # look at. This may run in one of the scan workers, so the walker
+    # can have several directories on the way at once
+    lead = task.blocks[0][0]
+    start = time.monotonic()
+    try:
+        lead["stats"].add("scandir")
+        with os.scandir(task.sourcepath) as it:
+            task.dirlist = list(it)
+    except OSError:
+        return
+
+    for p, included in task.blocks:
+        if "snapshotIndex" in p:
+            try:
+                lead["stats"].add("stat")
+                task.srcmtime = os.stat(task.sourcepath).st_mtime_ns
+            except OSError:
+                pass
+            break
+
+    for (p, included), view in zip(task.blocks, task.views):
+        if view["done"]:
+            continue
+        # if nothing has been added to or removed from this directory
+        # since the last run, quickscan trusts that its files are
+        # unchanged too and only looks at the subdirectories
+        if (view["indexed"] and "quickscan" in p and p["quickscan"] and not task.changed
+                and task.srcmtime != 0 and task.srcmtime == view["lastmtime"]):
+            view["quick"] = True
+            continue
+        complist = view["complist"]
+        destlist = view["destlist"]
+        noupdate = "noupdate" in p and p["noupdate"]
+        needstat = needSourceStat(p)
+        for entry in fileCandidates(p, task.dirlist):
+            if complist.stat(entry.name) is not None:
+                if not noupdate:
+                    sourceStat(p, entry, task.srcstats)
+            elif destlist is not complist and destlist.stat(entry.name) is not None:
+                sourceStat(p, entry, task.srcstats)
+            elif needstat:
+                sourceStat(p, entry, task.srcstats)
+        if "snapshotIndex" in p and not view["indexed"]:
+            # everything gets recorded in the index
+            complist.snapshot(())
+    task.scantime = time.monotonic() - start
+
+
+def wantDir(p:dict, included:bool, d:str, source:str):
+    # if there is an exclude directory list, check it
+    if "excludedirMatch" in p:
+        return not p["excludedirMatch"].match(d, source)
+    if "includedirMatch" in p and not included:
+        # if there is an include directory list, check it - note
+        # that there cannot be both an exclude AND an
+        # include list, and we checked for that conflict
+        # when constructing this work plan. Everything below
+        # an included directory is included as well
+        return p["includedirMatch"].match(d, source)
+    return True
+
+
+def dirBlocks(blocks:list, rel:str):
+    # the blocks that would reach the directory rel below the source
+    # when walking down to it, along with whether it is included
+    found = []
+    for p, included in blocks:
+        path = p["source"]
+        for d in rel.split(os.sep):
+            path = os.path.join(path, d)
+            if '~' == d[0] or not wantDir(p, included, d, path):
+                break
+            included = included or "includedirMatch" in p
+        else:
+            found.append((p, included))
+    return found
+
+
+def processTask(task:DirTask):
+    # make the decisions for a scanned directory, and return the
+    # subdirectories that still need to be walked
+    for p, included in task.blocks:
+        p["log"].debug("Processing %s", task.sourcepath)
+
+    if task.dirlist is None:
+        # can't access this directory - let the person know and leave
+        for p, included in task.blocks:
+            p["log"].error("Source directory %s could not be accessed", task.sourcepath)
+        return []
+
+    for (p, included), view in zip(task.blocks, task.views):
+        start = time.monotonic()
+        backupFiles(p, task, view)
+        elapsed = time.monotonic() - start
+        # the scan was shared, so each block is charged for all of it
+        p["stats"].time("scan", task.scantime)
+        p["stats"].time("decide", elapsed)
+        p["stats"].dirTime(task.sourcepath, task.scantime + elapsed)
+        if "profile" in p:
+            files = sum(1 for entry in task.dirlist if not entry.is_dir())
+            p["profile"].walked(task.sourcepath, task.scantime, elapsed, files)
+
+    children = []
+    for entry in task.dirlist:
+        d = entry.name
+        if '~' == d[0] or not entry.is_dir():
+            continue
+        source = entry.path
+        subblocks = []
+        for p, included in task.blocks:
+            p["log"].debug("Working %s", source)
+            if wantDir(p, included, d, source):
+                subblocks.append((p, included or "includedirMatch" in p))
+            else:
+                p["log"].info("Skipping %s", source)
+
+        if subblocks:
+            children.append(DirTask(subblocks, source, os.path.join(task.rel, d)))
+    return children
 
-    # wildcard in pattern
-    slen = len(src)
-    plen = len(pattern)
 
-    # if the wildcard is at the front, then check just the end
-    if pattern[0] == '*':
-        for n in range(plen-1):
-            if n > slen:
-                return False
-            if src[slen-n-1] != pattern[plen-n-1]:
-                return False
-        # got to the end with all matching
-        return True
+def walkTree(blocks:list, roots:list=None):
+    # walk a source tree once on behalf of all the config blocks
+    # reading it. Directories wait on a stack rather than in Python
+    # recursion, so the depth of the tree doesn't matter, and with
+    # scanjobs above one the filesystem work for several directories
+    # is in progress at the same time. Given roots - (rel, recursive)
+    # pairs - only those directories are walked
+    lead = blocks[0][0]
+    width = 1
+    for p, included in blocks:
+        if "scanjobs" in p:
+            width = max(width, p["scanjobs"])
+    scanners = None
+    if 1 < width:
+        scanners = ThreadPoolExecutor(max_workers=width)
 
-    # if wildcard is at the end, check the front
-    if pattern[plen-1] == '*':
-        for n in range(plen-1):
-            if n > slen:
-                return False
-            if src[n] != pattern[n]:
-                return False
-        # all checked and matching
-        return True
+    if roots is None:
+        stack = [DirTask(blocks, lead["source"], "")]
+    else:
+        stack = []
+        for rel, recursive in reversed(roots):
+            if rel:
+                subblocks = dirBlocks(blocks, rel)
+                sourcepath = os.path.join(lead["source"], rel)
+            else:
+                subblocks = blocks
+                sourcepath = lead["source"]
+            if subblocks:
+                task = DirTask(subblocks, sourcepath, rel)
+                task.recursive = recursive
+                task.changed = True
+                stack.append(task)
+    running = {}
+    try:
+        while (stack and not stopping.is_set()) or running:
+            while stack and len(running) < width and not stopping.is_set():
+                task = stack.pop()
+                prepareTask(task)
+                if scanners is None:
+                    scanTask(task)
+                    children = processTask(task)
+                    if task.recursive:
+                        stack.extend(reversed(children))
+                else:
+                    running[scanners.submit(scanTask, task)] = task
+            if running:
+                done, notdone = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    future.result()
+                    # children go on the stack in reverse so that they
+                    # come off it in the order they were listed
+                    children = processTask(task)
+                    if task.recursive:
+                        stack.extend(reversed(children))
+    finally:
+        if scanners is not None:
+            scanners.shutdown(wait=True, cancel_futures=True)
 
-    # wildcard in middle somewhere - we don't handle it yet
-    return False
 
+def backupFiles(p:dict, task:DirTask, view:dict):
+    sourcepath = task.sourcepath
+    rel = task.rel
+    dirlist = task.dirlist
+    srcstats = task.srcstats
+    srcmtime = task.srcmtime
+    if rel:
+        destpath = os.path.join(p["dest"], rel)
+        comppath = os.path.join(p["target"], rel)
+    else:
+        destpath = p["dest"]
+        comppath = p["target"]
 
-def backupDir(p:dict):
-    sourcepath = p["source"]
-    comppath = p["target"]
-    destpath = p["dest"]
+    index = None
+    if "snapshotIndex" in p:
+        index = p["snapshotIndex"]
+    indexed = view["indexed"]
 
-    msg = "Processing " + sourcepath
-    p["log"].debug(msg)
+    if view["done"]:
+        p["log"].debug("Directory %s was finished before the last run was interrupted", sourcepath)
+        return
 
-    try:
-        dirlist = os.listdir(sourcepath)
-    except:
-        # can't access this directory - let the person know and leave
-        msg = "Source directory " + sourcepath + " could not be accessed"
-        p["log"].error(msg)
+    if view["quick"]:
+        p["log"].debug("Directory %s unchanged since last run - checking subdirectories only", sourcepath)
         return
 
-    for d in dirlist:
-        source = os.path.join(sourcepath, d)
-        msg = "Working " + source
-        p["log"].debug(msg)
+    # the target and dest directories were only listed if a file
+    # in this directory actually needed to be compared against them
+    if indexed:
+        p["stats"].add("indexed")
+    complist = view["complist"]
+    destlist = view["destlist"]
+    madeDest = False
 
-        if '~' == d[0]:
-            pass
+    # files handed off to be copied - their index entries
+    # are updated when the copy completes
+    copying = set()
+    # small files going into this directory's packs
+    packing = []
+    # files taken out of a pack to be copied normally
+    unpacked = False
 
-        elif (os.path.isdir(source)):
-            # if there is an exclude directory list, check it
-            doprocess = True
-            if "excludedir" in p:
-                for e in p["excludedir"]:
-                    if checkmatch(source, e):
-                        doprocess = False
-                        break
-            elif "includedir" in p:
-                # if there is an include directory list, check it - note
-                # that there cannot be both an exclude AND an
-                # include list, and we checked for that conflict
-                # when constructing this work plan
-                doprocess = False
-                for e in p["includedir"]:
-                    if checkmatch(source, e):
-                        doprocess = True
-                        break
+    for entry in dirlist:
+        # on Ctrl-C, stop deciding - this directory won't be
+        # recorded as finished
+        if stopping.is_set():
+            return
 
-            if doprocess:
-                newP = p
-                newP["source"] = source
-                newP["target"] = os.path.join(comppath, d)
-                newP["dest"] = os.path.join(destpath, d)
-                backupDir(newP)
-            else:
-                msg = "Skipping " + source
-                p["log"].info(msg)
+        d = entry.name
+        if '~' == d[0] or entry.is_dir():
+            continue
 
-        elif '.' == d[0]:
-            msg = "Ignoring " + d
-            p["log"].debug(msg)
-            pass
+        source = entry.path
+        p["log"].debug("Working %s", source)
+        p["stats"].add("scanned")
 
-        else:
-            # this is a file - see if it is on the exclude list
-            doprocess = True
-            if "excludefile" in p:
-                for e in p["excludefile"]:
-                    if checkmatch(d, e):
-                        doprocess = False
-                        break
-                if not doprocess:
-                    msg = "Source " + source + " is excluded - ignoring"
-                    p["log"].info(msg)
+        if '.' == d[0]:
+            p["log"].debug("Ignoring %s", d)
+            p["stats"].add("skip:hidden")
+            continue
+
+        # this is a file - see if it is on the exclude list
+        doprocess = True
+        if "excludefileMatch" in p:
+            doprocess = not p["excludefileMatch"].match(d, source)
+            if not doprocess:
+                p["log"].info("Source %s is excluded - ignoring", source)
+                skipFile(p, source, "excluded")
+                continue
+
+        # if we were given explicit include directions, check
+        # to see if this one fits
+        elif "includefileMatch" in p:
+            doprocess = p["includefileMatch"].match(d, source)
+            if not doprocess:
+                p["log"].info("Source %s is not included - ignoring", source)
+                skipFile(p, source, "not included")
+                continue
+
+        # we want to consider this file
+        comp = os.path.join(comppath, d)
+        dest = os.path.join(destpath, d)
+        p["log"].debug("Comparing %s to %s", comp, source)
+
+        compstat = complist.stat(d)
+        if compstat is not None:
+            # the comparison file exists
+            keep = False
+            if "noupdate" in p and p["noupdate"]:
+                p["log"].debug("Target %s exists but NOUPDATE is set - ignoring", comp)
+                keep = True
+                reason = "noupdate"
+            else:
+                # is it different?
+                srcstat = sourceStat(p, entry, srcstats)
+                if srcstat is None:
                     continue
+                if not isChanged(p, source, srcstat, comp, compstat, "Target"):
+                    keep = True
+                    reason = "unchanged"
 
-            # if we were given explicit include directions, check
-            # to see if this one fits
-            elif "includefile" in p:
-                doprocess = False
-                for e in p["includefile"]:
-                    if checkmatch(d, e):
-                        doprocess = True
-                        break
-                if not doprocess:
-                    msg = "Source " + source + " is not included - ignoring"
-                    p["log"].info(msg)
+            if keep:
+                if "snapshot" not in p or not p["snapshot"]:
+                    skipFile(p, source, reason)
                     continue
+                # the new snapshot still needs the file - share it
+                # with the previous one if possible, or copy it over
+                if not madeDest:
+                    makeDest(p, destpath)
+                    madeDest = True
+                if not linkFile(p, comp, dest):
+                    copying.add(d)
+                    submitCopy(p, comp, dest, "Carrying over", copyDone(p, rel, d, comp, dest, compstat),
+                               rel, compstat)
+                continue
+
+            if "resumeJournal" in p and p["resumeJournal"].fileDone(os.path.join(rel, d), srcstat):
+                p["log"].debug("Source: %s was copied before the last run was interrupted", source)
+                p["stats"].add("skip:resumed")
+                continue
 
-            # we want to consider this file
-            comp = os.path.join(comppath, d)
-            dest = os.path.join(destpath, d)
-            msg = "Comparing " + comp + " to " + source
-            p["log"].debug(msg)
-
-            if (os.path.exists(comp)):
-                # the comparison file exists
-                if "noupdate" in p and p["noupdate"]:
-                    msg = "Target " + " exists but NOUPDATE is set - ignoring"
-                    p["log"].debug(msg)
+            copying.add(d)
+            if "packIndex" in p and not p["packIndex"].readonly:
+                if srcstat.st_size < p["pack"]:
+                    p["stats"].add("selected")
+                    packing.append((d, source, dest, copyDone(p, rel, d, source, dest, srcstat)))
                     continue
+                if destlist.isPacked(d):
+                    p["packIndex"].drop(rel, d)
+                    unpacked = True
+            submitCopy(p, source, dest, "Updating", copyDone(p, rel, d, source, dest, srcstat),
+                       rel, srcstat)
 
-                # is it different?
-                modtime = os.path.getmtime(source)
-                backuptime = os.path.getmtime(comp)
-                msg = "Source: " + source + " Modtime: " + "{:.2f}".format(modtime) + " Comptime: " + "{:.2f}".format(backuptime)
-                p["log"].debug(msg)
-                if modtime < backuptime:
-                    msg = "Target " + comp + " is newer - ignoring"
-                    p["log"].debug(msg)
+        else:
+            p["log"].debug("Target: %s does not exist", comp)
+
+            if dest != comp:
+                # check the dest to see if the file there already exists
+                deststat = destlist.stat(d)
+                if deststat is not None:
+                    # is the source newer?
+                    srcstat = sourceStat(p, entry, srcstats)
+                    if srcstat is None:
+                        continue
+                    if not isChanged(p, source, srcstat, dest, deststat, "Destination"):
+                        skipFile(p, source, "unchanged")
+                        continue
+
+            if "noallext" in p and p["noallext"]:
+                # check to see if only the extension differs
+                # between source and comparison
+                if complist.hasStem(os.path.splitext(d)[0]):
+                    # ignore the file
+                    p["log"].info("Found matching file with different extension: %s", source)
+                    skipFile(p, source, "other extension")
                     continue
-                if modtime == backuptime:
-                    msg = "Target and source are of same age - ignoring"
-                    p["log"].debug(msg)
+
+            # only need to create the dest path once per directory
+            if not madeDest:
+                makeDest(p, destpath)
+                madeDest = True
+
+            if needSourceStat(p):
+                srcstat = sourceStat(p, entry, srcstats)
+                if srcstat is None:
                     continue
+            else:
+                srcstat = None
+            if "resumeJournal" in p and p["resumeJournal"].fileDone(os.path.join(rel, d), srcstat):
+                p["log"].debug("Source: %s was copied before the last run was interrupted", source)
+                p["stats"].add("skip:resumed")
+                continue
 
-                msg = "Source: " + source + " is newer - updating"
-                try:
-                    if "dryrun" in p and p["dryrun"]:
-                        p["log"].info(msg)
-                    else:
-                        p["log"].debug(msg)
-                        shutil.copy2(source, dest)
-                # If source and destination are same
-                except shutil.SameFileError:
-                    msg = "Source and destination represents the same file: " + source
-                    p["log"].error(msg)
-                    pass
+            copying.add(d)
+            if "packIndex" in p and not p["packIndex"].readonly:
+                if srcstat.st_size < p["pack"]:
+                    p["stats"].add("selected")
+                    packing.append((d, source, dest, copyDone(p, rel, d, source, dest, srcstat)))
+                    continue
+                if destlist.isPacked(d):
+                    p["packIndex"].drop(rel, d)
+                    unpacked = True
+            submitCopy(p, source, dest, "Backing up", copyDone(p, rel, d, source, dest, srcstat),
+                       rel, srcstat)
 
-                # If there is any permission issue
-                except PermissionError:
-                    msg = "Permission denied for: " + source + " to " + dest
-                    p["log"].error(msg)
-                    pass
+    if packing:
+        p["log"].debug("Packing %s files into %s", len(packing), destpath)
+        submitPack(p, rel, destpath, packing)
+    elif unpacked:
+        # packing prunes the directory's packs when it's done
+        prunePacks(p, rel, destpath)
 
-                except (IOError, OSError) as err:
-                    msg = "Error backing up: " + source + " Error: " + str(err)
-                    p["log"].debug(msg)
-                    pass
+    if index is not None:
+        # record what the target looked like, unless we got it from
+        # the index in the first place
+        if not indexed:
+            index.recordDir(rel, srcmtime, complist.snapshot(copying))
+        else:
+            index.recordDir(rel, srcmtime, {})
+        index.flush()
+    if "digests" in p:
+        p["digests"].flush()
+    if "resumeJournal" in p:
+        p["resumeJournal"].endDir(rel)
 
-                except:
-                    msg = "Unrecognized error: " + source
-                    p["log"].error(msg)
-                    pass
 
-            else:
-                msg = "Target: " + comp + " does not exist"
-                p["log"].debug(msg)
-
-                if dest != comp:
-                    # check the dest to see if the file there already exists
-                    if (os.path.exists(dest)):
-                        # is the source newer?
-                        modtime = os.path.getmtime(source)
-                        backuptime = os.path.getmtime(dest)
-                        msg = "Source: " + source + " Modtime: " + "{:.2f}".format(modtime) + " Desttime: " + "{:.2f}".format(backuptime)
-                        p["log"].debug(msg)
-                        if modtime < backuptime:
-                            msg = "Destination " + comp + " is newer - ignoring"
-                            p["log"].debug(msg)
-                            continue
-                        if modtime == backuptime:
-                            msg = "Destination and source are of same age - ignoring"
-                            p["log"].debug(msg)
-                            continue
-
-                if "noallext" in p and p["noallext"]:
-                    # check to see if only the extension differs
-                    # between source and comparison
-                    baseComp = os.path.splitext(comp)[0]
-                    newComp = baseComp + ".*"
-                    if glob.glob(newComp):
-                        # ignore the file
-                        msg = "Found matching file with different extension: " + source
-                        p["log"].info(msg)
-                        continue
+def openManifest(path:str, mode:str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
 
-                try:
-                    msg = "Making dest path: " + destpath
-                    if "dryrun" in p and p["dryrun"]:
-                        p["log"].info(msg)
-                    else:
-                        p["log"].debug(msg)
-                        os.makedirs(destpath)
-                except OSError:
-                    # directory already exists
-                    pass
 
-                try:
-                    msg = "Backing up: " + source + " to " + dest
-                    if "dryrun" in p and p["dryrun"]:
-                        p["log"].info(msg)
-                    else:
-                        p["log"].debug(msg)
-                        shutil.copy2(source, dest)
-                # If source and destination are same
-                except shutil.SameFileError:
-                    msg = "Source and destination represents the same file: " + source
-                    p["log"].error(msg)
-                    pass
+class Manifest:
+    """JSON-lines record of the actions a planning run decided on,
+    streamed out as the walk goes and read back by --apply-manifest.
+    Each config block starts with a "block" record holding its
+    settings and ends with an "end" record holding the totals, and
+    every record in between carries the number of its block"""
 
-                # If there is any permission issue
-                except PermissionError:
-                    msg = "Permission denied for: " + source + " to " + dest
-                    p["log"].error(msg)
-                    pass
+    def __init__(self, path:str):
+        self.f = openManifest(path, "w")
+        self.lock = threading.Lock()
+        self.blocks = 0
 
-                except (IOError, OSError) as err:
-                    msg = "Error backing up: " + source + " Error: " + str(err)
-                    p["log"].debug(msg)
-                    pass
+    def write(self, record:dict):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.f.write(line)
 
-                except:
-                    msg = "Unrecognized error: " + source
-                    p["log"].error(msg)
-                    pass
+    def startBlock(self, p:dict):
+        with self.lock:
+            p["manifestBlock"] = self.blocks
+            self.blocks += 1
+        config = {}
+        for e in validOptions:
+            if e in p:
+                config[e] = p[e]
+        # the manifest may be applied from somewhere else
+        for e in ["source", "target", "dest"]:
+            config[e] = os.path.abspath(config[e])
+        self.write({"block": p["manifestBlock"], "op": "block", "config": config})
+
+    def finishBlock(self, p:dict):
+        self.write({"block": p["manifestBlock"], "op": "end",
+                    "files": p["stats"].get("planned"),
+                    "bytes": p["stats"].get("plannedbytes")})
+
+    def copy(self, p:dict, source:str, dest:str, rel:str, st):
+        p["stats"].add("planned")
+        p["stats"].add("plannedbytes", st.st_size)
+        self.write({"block": p["manifestBlock"], "op": "copy",
+                    "src": os.path.abspath(source), "dest": os.path.abspath(dest), "rel": rel, "name": os.path.basename(dest),
+                    "size": st.st_size, "mtime_ns": st.st_mtime_ns})
+
+    def mkdir(self, p:dict, path:str):
+        self.write({"block": p["manifestBlock"], "op": "mkdir", "path": os.path.abspath(path)})
+
+    def skip(self, p:dict, source:str, reason:str):
+        self.write({"block": p["manifestBlock"], "op": "skip", "src": os.path.abspath(source),
+                    "reason": reason})
+
+    def close(self):
+        self.f.close()
+
+
+def skipFile(p:dict, source:str, reason:str):
+    # count a file that is being left alone, and note it in the
+    # manifest when planning
+    p["stats"].add("skip:" + reason)
+    if "manifest" in p:
+        p["manifest"].skip(p, source, reason)
+
+
+def applyManifest(path:str, options):
+    # carry out the copies a planning run wrote to a manifest,
+    # one config block at a time
+    blocks = {}
+    ops = {}
+    try:
+        f = openManifest(path, "r")
+    except OSError as err:
+        print("Manifest", path, "could not be opened:", err)
+        sys.exit(1)
+    with f:
+        for line in f:
+            rec = json.loads(line)
+            n = rec["block"]
+            if rec["op"] == "block":
+                config = rec["config"]
+                # the cmd line settings override the manifest
+                if options.jobs:
+                    config["jobs"] = parseJobs(options.jobs)
+                if options.bwlimit:
+                    config["bwlimit"] = options.bwlimit
+                if options.dryrun:
+                    config["dryrun"] = True
+                if options.debug:
+                    config["debug"] = True
+                if not validate(config):
+                    print("Block", n, "of manifest", path, "contained an error - not processing")
+                    config = None
+                elif options.profile:
+                    # not a config option, so only once it's validated
+                    config["profiling"] = True
+                blocks[n] = config
+                ops[n] = {"mkdir": [], "copy": []}
+            elif rec["op"] in ops[n]:
+                ops[n][rec["op"]].append(rec)
+
+    process = []
+    for n in sorted(blocks):
+        p = blocks[n]
+        if p is None:
+            continue
+        # directories first, then the copies grouped by the
+        # directory they go into
+        mkdirs = sorted(rec["path"] for rec in ops[n]["mkdir"])
+        copies = sorted(ops[n]["copy"], key=lambda rec: rec["dest"])
+        total = sum(rec["size"] for rec in copies)
+        if "title" in p:
+            name = p["title"]
+        else:
+            name = p["source"]
+        print("Applying:", name, "-", len(copies), "files,", "{:.1f}".format(total / 1e6), "MB")
+
+        start = time.monotonic()
+        if not startBlock(p):
+            continue
+        process.append(p)
+        for d in mkdirs:
+            if "dryrun" in p and p["dryrun"]:
+                p["log"].info("Making dest path: %s", d)
+                continue
+            p["log"].debug("Making dest path: %s", d)
+            try:
+                p["stats"].add("mkdir")
+                makeDirs(d)
+            except OSError as err:
+                p["log"].error("Could not create %s: %s", d, err)
+        for rec in copies:
+            if stopping.is_set():
+                break
+            st = IndexStat(rec["size"], rec["mtime_ns"])
+            submitCopy(p, rec["src"], rec["dest"], "Backing up",
+                       copyDone(p, rec["rel"], rec["name"], rec["src"], rec["dest"], st))
+        finishBlock(p)
+        p["elapsed"] = time.monotonic() - start
+    return process
 
 
 def process_option(config, opt):
@@ -269,11 +2333,72 @@ def process_option(config, opt):
             return True
         if cmd == "allext":
             if tgt == "false":
-                config["allext"] = False
+                config["noallext"] = True
+            return True
+        if cmd == "noallext":
+            if tgt == "true":
+                config["noallext"] = True
             return True
         if cmd == "log":
             config["logFile"] = tgt
             return True
+        if cmd == "logformat":
+            config["logformat"] = tgt
+            return True
+        if cmd == "journal":
+            # keep the case of the path
+            config["journal"] = opt.split('=', 1)[1].strip()
+            return True
+        if cmd == "store":
+            # keep the case of the path
+            config["store"] = opt.split('=', 1)[1].strip()
+            return True
+        if cmd == "index":
+            # keep the case of the path
+            config["index"] = opt.split('=', 1)[1].strip()
+            return True
+        if cmd == "pack":
+            try:
+                config["pack"] = parseSize(tgt)
+            except ValueError:
+                print("pack must be a size:", tgt)
+                return False
+            return True
+        if cmd == "bufsize":
+            try:
+                config["bufsize"] = parseSize(tgt)
+            except ValueError:
+                print("bufsize must be a size:", tgt)
+                return False
+            return True
+        if cmd == "compare":
+            if tgt not in compareModes:
+                print("compare must be one of", ", ".join(compareModes))
+                return False
+            config["compare"] = tgt
+            return True
+        if cmd == "scanjobs":
+            try:
+                config["scanjobs"] = int(tgt)
+            except ValueError:
+                print("scanjobs must be an integer:", tgt)
+                return False
+            return True
+        if cmd == "jobs":
+            try:
+                config["jobs"] = parseJobs(tgt)
+            except ValueError:
+                print("jobs must be an integer or auto:", tgt)
+                return False
+            return True
+        if cmd == "bwlimit":
+            try:
+                parseBwlimit(tgt)
+            except ValueError:
+                print("bwlimit must be a rate, optionally with the hours it applies, e.g. 10M@08:00-20:00:", tgt)
+                return False
+            config["bwlimit"] = tgt
+            return True
     else:
         if tst == "dryrun":
             config["dryrun"] = True
@@ -285,7 +2410,19 @@ def process_option(config, opt):
             config["noupdate"] = True
             return True
         if tst == "noallext":
-            config["allext"] = False
+            config["noallext"] = True
+            return True
+        if tst == "verify":
+            config["verify"] = True
+            return True
+        if tst == "quickscan":
+            config["quickscan"] = True
+            return True
+        if tst == "snapshot":
+            config["snapshot"] = True
+            return True
+        if tst == "delta":
+            config["delta"] = True
             return True
 
     # must not be a recognized option
@@ -294,7 +2431,9 @@ def process_option(config, opt):
 
 validOptions = ["source", "target", "dest", "dryrun", "debug",
                 "title", "excludedir", "includedir", "excludefile",
-                "includefile", "noupdate", "noallext", "logFile"]
+                "includefile", "noupdate", "noallext", "logFile",
+                "jobs", "index", "verify", "quickscan", "bufsize", "compare",
+                "scanjobs", "journal", "logformat", "snapshot", "store", "pack", "delta", "bwlimit"]
 
 def validate(config):
     # check for invalid options
@@ -331,37 +2470,722 @@ def validate(config):
             if not os.path.exists(config["dest"]):
                 print("ERROR: DESTINATION path", config["dest"], "could not be created")
                 return False
+    # must have at least one copy worker
+    if "jobs" in config and config["jobs"] != "auto" and config["jobs"] < 1:
+        print("jobs must be at least 1")
+        return False
+    if "scanjobs" in config and config["scanjobs"] < 1:
+        print("scanjobs must be at least 1")
+        return False
+    if "bufsize" in config and config["bufsize"] < 4096:
+        print("bufsize must be at least 4K")
+        return False
+    # compile the pattern lists
+    for e in ["excludedir", "includedir", "excludefile", "includefile"]:
+        if e in config:
+            try:
+                config[e + "Match"] = Matcher(config[e])
+            except re.error as err:
+                print("Invalid", e.upper(), "pattern:", err)
+                return False
     # if they didn't give us a TARGET directory, default
     # it to the DESTINATION
     if not "target" in config:
         config["target"] = config["dest"]
-    # if we have a logFile, then setup the logger for it
-    logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
-    if "logFile" in config:
-        config["log"] = logging.getLogger("")
-        fileHandler = logging.FileHandler(config["logFile"])
-        fileHandler.setFormatter(logFormatter)
-        config["log"].addHandler(fileHandler)
-        if "debug" in config and config["debug"]:
-            config["log"].setLevel(logging.DEBUG)
+    if "logformat" in config and config["logformat"] not in logFormats:
+        print("Invalid LOGFORMAT:", config["logformat"])
+        return False
+
+    return True
+
+
+class JSONFormatter(logging.Formatter):
+    """Writes each record as a single line JSON object"""
+
+    def format(self, record):
+        rec = {"time": self.formatTime(record), "level": record.levelname}
+        if hasattr(record, "block"):
+            rec["block"] = record.block
+        rec["msg"] = record.getMessage()
+        if record.exc_info:
+            rec["exc"] = self.formatException(record.exc_info)
+        return json.dumps(rec)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread as they are, so that the
+    message only gets formatted there, and not in the thread doing
+    the backup"""
+
+    def prepare(self, record):
+        return record
+
+
+logFormats = ["text", "json"]
+
+# one queue, handler and writer thread for each log destination,
+# shared by every config block logging to it
+logSinks = {}
+logSinksLock = threading.Lock()
+
+def logSink(path:str, fmt:str):
+    # path is None for stdout
+    if path is not None:
+        path = os.path.abspath(path)
+    key = (path, fmt)
+    with logSinksLock:
+        if key not in logSinks:
+            if path is None:
+                handler = logging.StreamHandler(sys.stdout)
+            else:
+                handler = logging.FileHandler(path)
+            if fmt == "json":
+                handler.setFormatter(JSONFormatter())
+            else:
+                handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s"))
+            q = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(q, handler)
+            listener.start()
+            logSinks[key] = (LogQueueHandler(q), listener)
+        return logSinks[key][0]
+
+
+def stopLogging():
+    # wait for the writer threads to drain their queues
+    with logSinksLock:
+        for handler, listener in logSinks.values():
+            listener.stop()
+            for h in listener.handlers:
+                h.close()
+        logSinks.clear()
+
+# make sure whatever is still queued gets written, however we exit
+atexit.register(stopLogging)
+
+
+blockLoggers = iter(range(1, sys.maxsize))
+
+def setupLog(p:dict):
+    # each config block gets a logger of its own, which doesn't
+    # pass records up to the root logger
+    logger = logging.getLogger("backup." + str(next(blockLoggers)))
+    logger.propagate = False
+    if "logformat" in p:
+        fmt = p["logformat"]
+    else:
+        fmt = "text"
+    if "logFile" in p:
+        logger.addHandler(logSink(p["logFile"], fmt))
+        if "debug" in p and p["debug"]:
+            logger.setLevel(logging.DEBUG)
+        else:
+            logger.setLevel(logging.INFO)
+    else:
+        logger.addHandler(logSink(None, fmt))
+        if "debug" in p and p["debug"]:
+            logger.setLevel(logging.DEBUG)
         else:
-            config["log"].setLevel(logging.INFO)
-    elif "debug" in config and config["debug"]:
-        config["log"] = logging.getLogger("")
-        fileHandler = logging.StreamHandler(sys.stdout)
-        fileHandler.setFormatter(logFormatter)
-        config["log"].addHandler(fileHandler)
-        config["log"].setLevel(logging.DEBUG)
+            logger.setLevel(logging.WARN)
+    if "title" in p:
+        name = p["title"]
+    else:
+        name = p["source"]
+    p["log"] = logging.LoggerAdapter(logger, {"block": name})
+
+snapshotName = re.compile(r"^\d{4}-\d{2}-\d{2}_\d{6}$")
+
+def startSnapshot(p:dict):
+    # DEST holds the snapshots - point DEST at a new dated one and
+    # TARGET at the last one to be completed. A snapshot an
+    # interrupted run left unfinished gets finished instead
+    if "snapshotRoot" not in p:
+        p["snapshotRoot"] = p["dest"]
+        p["snapshotTarget"] = p["target"]
+    # a --watch pass starts again from the DEST and TARGET the block
+    # was given, not from the last pass's snapshot
+    root = p["snapshotRoot"]
+    p["target"] = p["snapshotTarget"]
+    complete = []
+    partial = []
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if snapshotName.match(name):
+            complete.append(name)
+        elif name.endswith(".partial") and snapshotName.match(name[:-8]):
+            partial.append(name)
+    if partial:
+        dest = os.path.join(root, max(partial))
     else:
-        config["log"] = logging.getLogger("")
-        fileHandler = logging.StreamHandler(sys.stdout)
-        fileHandler.setFormatter(logFormatter)
-        config["log"].addHandler(fileHandler)
-        config["log"].setLevel(logging.WARN)
+        dest = os.path.join(root, time.strftime("%Y-%m-%d_%H%M%S") + ".partial")
+    if complete:
+        p["target"] = os.path.join(root, max(complete))
+    elif p["target"] == root:
+        # the first snapshot is a full copy, unless a TARGET of its
+        # own was given to start from
+        p["target"] = dest
+    p["dest"] = dest
+    p["log"].info("Snapshot: %s, previous: %s", dest, p["target"])
+
+
+def finishSnapshot(p:dict):
+    # give the completed snapshot its final name, and point
+    # "latest" at it
+    final = p["dest"][:-8]
+    try:
+        makeDirs(p["dest"])
+        os.rename(p["dest"], final)
+    except OSError as err:
+        p["log"].error("Snapshot %s could not be completed: %s", p["dest"], err)
+        p["stats"].add("errors")
+        return
+    latest = os.path.join(p["snapshotRoot"], "latest")
+    try:
+        os.symlink(os.path.basename(final), latest + ".new")
+        os.replace(latest + ".new", latest)
+    except OSError as err:
+        p["log"].warning("Could not point %s at the new snapshot: %s", latest, err)
+
+
+def startBlock(p:dict):
+    if "log" not in p:
+        setupLog(p)
+    if "title" in p:
+        p["log"].debug("Processing: %s", p["title"])
+    p["stats"] = Stats()
+    if "profiling" in p and p["profiling"]:
+        p["profile"] = DirProfile()
+    if "index" in p:
+        if "title" in p:
+            key = p["title"]
+        else:
+            key = p["source"]
+        try:
+            p["snapshotIndex"] = SnapshotIndex(p["index"], key)
+        except sqlite3.Error as err:
+            print("Snapshot index", p["index"], "could not be opened:", err)
+            p["stats"].add("errors")
+            return False
+    if ("compare" in p and p["compare"] == "hash") or "store" in p:
+        try:
+            if "index" in p:
+                p["digests"] = DigestCache(p["index"])
+            else:
+                p["digests"] = DigestCache()
+        except sqlite3.Error as err:
+            print("Digest cache", p["index"], "could not be opened:", err)
+            p["stats"].add("errors")
+            return False
+    if "store" in p and not ("dryrun" in p and p["dryrun"]) and "manifest" not in p:
+        try:
+            p["contentStore"] = openStore(p["store"])
+        except (OSError, sqlite3.Error) as err:
+            print("Content store", p["store"], "could not be opened:", err)
+            p["stats"].add("errors")
+            return False
+    if "pack" in p and "snapshot" in p and p["snapshot"]:
+        # packs can't be hard-linked into the next snapshot a file
+        # at a time
+        p["log"].warning("PACK can't be used with SNAPSHOT - ignoring it")
+    elif "pack" in p:
+        # a dry or planning run only needs to know what is already
+        # packed, and there's nothing to know if no pack was written
+        readonly = ("dryrun" in p and p["dryrun"]) or "manifest" in p
+        try:
+            if not readonly or os.path.exists(os.path.join(p["dest"], PACK_INDEX)):
+                p["packIndex"] = PackIndex(p["dest"], readonly)
+        except (OSError, sqlite3.Error) as err:
+            print("Pack index in", p["dest"], "could not be opened:", err)
+            p["stats"].add("errors")
+            return False
+    if "snapshot" in p and p["snapshot"]:
+        if "manifest" in p:
+            print("SNAPSHOT blocks can't be planned -", p["source"], "not processed")
+            p["stats"].add("errors")
+            return False
+        startSnapshot(p)
+        if "quickscan" in p and p["quickscan"]:
+            # the files skipped in unchanged directories would be
+            # missing from the new snapshot
+            p["log"].warning("QUICKSCAN can't be used with SNAPSHOT - ignoring it")
+            p["quickscan"] = False
+    if "journal" in p and not ("dryrun" in p and p["dryrun"]) and "manifest" not in p:
+        if "title" in p:
+            key = p["title"]
+        else:
+            key = p["source"]
+        try:
+            p["resumeJournal"] = Journal(journalPath(p["journal"], key))
+        except OSError as err:
+            print("Journal for", key, "could not be opened:", err)
+            p["stats"].add("errors")
+            return False
+        if p["resumeJournal"].resumed():
+            p["log"].warning("Resuming interrupted run: %s directories and %s files already done", len(p["resumeJournal"].dirs), len(p["resumeJournal"].files))
+    if "bwlimit" in p and not ("dryrun" in p and p["dryrun"]) and "manifest" not in p:
+        p["bandwidth"] = tokenBucket(p["bwlimit"])
+    if "manifest" in p:
+        p["manifest"].startBlock(p)
+    elif "jobs" in p and (p["jobs"] == "auto" or p["jobs"] > 1) and not ("dryrun" in p and p["dryrun"]):
+        p["pool"] = CopyPool(p["jobs"], p)
+    return True
+
+
+def finishBlock(p:dict):
+    start = time.monotonic()
+    if "pool" in p:
+        p["pool"].shutdown()
+    p["stats"].time("drain", time.monotonic() - start)
+    if "packIndex" in p:
+        p["packIndex"].close()
+    if "manifest" in p:
+        p["manifest"].finishBlock(p)
+    interrupted = stopping.is_set()
+    if "resumeJournal" in p:
+        # keep the journal if we didn't get to the end
+        p["resumeJournal"].close(not interrupted)
+    if "snapshotIndex" in p:
+        # nothing gets recorded for a dry, planning or interrupted run -
+        # a planned directory isn't backed up until the manifest is applied
+        if not ("dryrun" in p and p["dryrun"]) and "manifest" not in p and not interrupted:
+            start = time.monotonic()
+            p["snapshotIndex"].commit("verify" in p and p["verify"])
+            p["stats"].time("commit", time.monotonic() - start)
+        p["snapshotIndex"].close()
+    if interrupted:
+        p["log"].warning("Processing of %s was interrupted", p["source"])
+    elif "snapshotRoot" in p and not ("dryrun" in p and p["dryrun"]):
+        finishSnapshot(p)
+    if "contentStore" in p:
+        closeStore(p["contentStore"])
+        p["log"].debug("Content store: %s files stored, %s files (%s bytes) already there", p["stats"].get("stored"), p["stats"].get("dedup"), p["stats"].get("dedupbytes"))
+    if "digests" in p:
+        p["digests"].close()
+        p["log"].debug("Hashed %s files, %s bytes", p["stats"].get("hashed"), p["stats"].get("hashbytes"))
+    p["log"].debug("Filesystem calls: %s directory scans, %s stats, %s mkdirs, %s directories from the index", p["stats"].get("scandir"), p["stats"].get("stat"), p["stats"].get("mkdir"), p["stats"].get("indexed"))
+
+
+def runGroup(group:list, roots:list=None):
+    # all the blocks in a group read the same source tree,
+    # which gets walked once for all of them
+    start = time.monotonic()
+    active = []
+    for p in group:
+        if startBlock(p):
+            active.append(p)
+    if active:
+        walkTree([(p, False) for p in active], roots)
+    for p in active:
+        finishBlock(p)
+        p["elapsed"] = time.monotonic() - start
+
+
+def groupBlocks(process:list):
+    groups = {}
+    for p in process:
+        key = os.path.normpath(os.path.abspath(p["source"]))
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(p)
+    return list(groups.values())
+
+
+def destVolume(path:str):
+    # the mount point holding the given path, which may not exist yet
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def runParallel(groups:list, parallel:int, perdest:int):
+    # run up to parallel groups of config blocks at a time, but never
+    # let more than perdest of them write to the same volume. Groups
+    # are started in the order given whenever there is room for them
+    finished = queue.Queue()
+    pending = list(groups)
+    busy = {}
+    running = 0
+
+    def volumes(group):
+        return set(p["volume"] for p in group)
+
+    def worker(group):
+        try:
+            runGroup(group)
+        except Exception as err:
+            group[0]["log"].error("Processing %s failed: %s", group[0]["source"], err)
+            for p in group:
+                if "stats" in p:
+                    p["stats"].add("errors")
+        finally:
+            finished.put(group)
+
+    while (pending and not stopping.is_set()) or 0 < running:
+        for group in list(pending):
+            if running >= parallel or stopping.is_set():
+                break
+            if any(busy.get(v, 0) >= perdest for v in volumes(group)):
+                continue
+            pending.remove(group)
+            for v in volumes(group):
+                busy[v] = busy.get(v, 0) + 1
+            running += 1
+            threading.Thread(target=worker, args=(group,), daemon=True).start()
+        group = finished.get()
+        for v in volumes(group):
+            busy[v] -= 1
+        running -= 1
+
+
+def blockName(p:dict):
+    if "title" in p:
+        return p["title"]
+    return p["source"]
+
+
+def skipCount(counts:dict):
+    return sum(n for key, n in counts.items() if key.startswith("skip:"))
+
+
+# inotify event bits
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_ONLYDIR)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class Inotify:
+    """The Linux inotify interface, through ctypes. Each watched
+    directory reports changes to the entries in it"""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {}
 
+    def add(self, path:str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+
+    def read(self, timeout:float):
+        # the (directory, mask, name) of each event that arrives
+        # within timeout seconds
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_IGNORED:
+                # the directory has gone
+                self.watches.pop(wd, None)
+                continue
+            events.append((self.watches.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watchTree(notify:Inotify, top:str):
+    # watch top and every directory below it that the walk would go into
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        try:
+            notify.add(path)
+            with os.scandir(path) as it:
+                for entry in it:
+                    if '~' != entry.name[0] and entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        except OSError as err:
+            if err.errno == errno.ENOSPC:
+                # out of watches - the reconciliation scans will
+                # have to catch whatever happens below here
+                print("Too many directories to watch - raise fs.inotify.max_user_watches")
+                return False
     return True
 
-def main():
+
+def sourceRel(source:str, path:str):
+    # where path is below source, or None if it isn't
+    source = os.path.normpath(os.path.abspath(source))
+    path = os.path.normpath(os.path.abspath(path))
+    if path == source:
+        return ""
+    if path.startswith(source + os.sep):
+        return path[len(source) + 1:]
+    return None
+
+
+def runChanges(groups:list, changed:dict):
+    # push the directories that changed through their groups - changed
+    # maps each directory to whether it needs walking all the way down
+    for group in groups:
+        if stopping.is_set():
+            break
+        # a snapshot only gets taken on the full scans
+        group = [p for p in group if not ("snapshot" in p and p["snapshot"])]
+        if not group:
+            continue
+        roots = []
+        for path, recursive in changed.items():
+            rel = sourceRel(group[0]["source"], path)
+            if rel is not None:
+                roots.append((rel, recursive))
+        if not roots:
+            continue
+        roots.sort()
+        runGroup(group, roots)
+        for p in group:
+            if "stats" in p and (p["stats"].get("copied") or p["stats"].get("errors")):
+                print("Watch: {} - {} files copied, {} errors".format(blockName(p),
+                      p["stats"].get("copied") + p["stats"].get("packed"), p["stats"].get("errors")))
+
+
+def runAll(groups:list):
+    for group in groups:
+        if stopping.is_set():
+            break
+        runGroup(group)
+
+
+def watchGroups(groups:list, debounce:float, reconcile:float):
+    # follow the changes to the source trees, backing up each directory
+    # that changes once things have been quiet in it for debounce
+    # seconds, and rescan everything every reconcile seconds to pick
+    # up whatever the events missed
+    try:
+        notify = Inotify()
+    except (OSError, AttributeError) as err:
+        print("Can't watch for changes here (" + str(err) + ") - scanning every", reconcile, "seconds instead")
+        while not stopping.wait(reconcile):
+            runAll(groups)
+        return
+    for group in groups:
+        watchTree(notify, group[0]["source"])
+    print("Watching", len(notify.watches), "directories for changes")
+    lastscan = time.monotonic()
+    changed = {}
+    first = None
+    last = None
+    # don't hold a batch back for ever if changes never stop
+    longest = max(debounce * 10, 60.0)
+    try:
+        while not stopping.is_set():
+            now = time.monotonic()
+            timeout = lastscan + reconcile - now
+            if changed:
+                timeout = min(timeout, last + debounce - now, first + longest - now)
+            rescan = False
+            # wake up now and then to see if we've been stopped
+            for path, mask, name in notify.read(min(max(timeout, 0.0), 1.0)):
+                if mask & IN_Q_OVERFLOW:
+                    # events got lost - only a full scan will do
+                    rescan = True
+                    continue
+                if path is None:
+                    continue
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and '~' != name[0]:
+                        # a new directory - watch it, and back up
+                        # everything in it
+                        sub = os.path.join(path, name)
+                        watchTree(notify, sub)
+                        changed[sub] = True
+                    else:
+                        continue
+                elif not name or name[0] in ".~":
+                    continue
+                elif path not in changed:
+                    changed[path] = False
+                if first is None:
+                    first = time.monotonic()
+                last = time.monotonic()
+            now = time.monotonic()
+            if rescan or now >= lastscan + reconcile:
+                runAll(groups)
+                lastscan = time.monotonic()
+                changed = {}
+                first = None
+                last = None
+            elif changed and (now >= last + debounce or now >= first + longest):
+                batch = changed
+                changed = {}
+                first = None
+                last = None
+                runChanges(groups, batch)
+    finally:
+        notify.close()
+
+
+def printSummary(process:list):
+    print("{:<30} {:>10} {:>10} {:>10} {:>10} {:>8} {:>8} {:>10}".format("Config", "Scanned", "Skipped", "Copied", "MB", "MB/s", "Errors", "Seconds"))
+    totals = {}
+    elapsed = 0.0
+    slowest = []
+    for p in process:
+        if "stats" not in p:
+            continue
+        counts, timers = p["stats"].snapshot()
+        seconds = 0.0
+        if "elapsed" in p:
+            seconds = p["elapsed"]
+        elapsed = max(elapsed, seconds)
+        mbps = 0.0
+        if 0 < seconds:
+            mbps = counts.get("bytes", 0) / 1e6 / seconds
+        print("{:<30} {:>10} {:>10} {:>10} {:>10.1f} {:>8.1f} {:>8} {:>10.1f}".format(blockName(p)[:30],
+              counts.get("scanned", 0), skipCount(counts), counts.get("copied", 0),
+              counts.get("bytes", 0) / 1e6, mbps, counts.get("errors", 0), seconds))
+        for key, n in counts.items():
+            totals[key] = totals.get(key, 0) + n
+        slowest.extend(p["stats"].slowest())
+    print("{:<30} {:>10} {:>10} {:>10} {:>10.1f} {:>8} {:>8}".format("Total",
+          totals.get("scanned", 0), skipCount(totals), totals.get("copied", 0),
+          totals.get("bytes", 0) / 1e6, "", totals.get("errors", 0)))
+    # the decisions behind the skipped count
+    reasons = sorted(key for key in totals if key.startswith("skip:"))
+    if reasons:
+        print("Skipped: " + ", ".join(key[5:] + " " + str(totals[key]) for key in reasons))
+    if "linked" in totals:
+        print("Linked from the previous snapshot:", totals["linked"])
+    if "delta" in totals:
+        print("Updated in place:", totals["delta"], "files,", "{:.1f}".format(totals["deltasaved"] / 1e6), "MB not sent")
+    if "packed" in totals:
+        print("Packed instead of copied:", totals["packed"], "files")
+    if "dedup" in totals:
+        print("Already in the content store:", totals["dedup"], "files,", "{:.1f}".format(totals["dedupbytes"] / 1e6), "MB")
+    if slowest:
+        print("Slowest directories:")
+        for seconds, path in sorted(slowest, reverse=True)[:Stats.SLOWEST]:
+            print("  {:>8.2f}s  {}".format(seconds, path))
+
+
+def printProfile(process:list, top:int):
+    # the most expensive subtrees of each block, by the time spent
+    # scanning, deciding and copying in them
+    for p in process:
+        if "profile" not in p:
+            continue
+        if "title" in p:
+            print("Profile of", p["title"], "-", p["source"])
+        else:
+            print("Profile of", p["source"])
+        totals = p["profile"].subtrees(p["source"])
+        print("  {:>9} {:>9} {:>9} {:>9} {:>10}  {}".format("Total", "Scan", "Decide", "Copy", "Files", "Subtree"))
+        ranked = sorted(totals.items(), key=lambda i: i[1][0] + i[1][1] + i[1][2], reverse=True)
+        for path, t in ranked[:top]:
+            print("  {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>10}  {}".format(t[0] + t[1] + t[2], t[0], t[1], t[2], t[3], path))
+
+
+def finishProfile(options, profiler, sampler, process:list):
+    profiler.disable()
+    sampler.stop()
+    printProfile(process, options.profiletop)
+    print("Functions taking the most time in the main thread:")
+    stats = pstats.Stats(profiler, stream=sys.stdout)
+    stats.sort_stats("cumulative").print_stats(options.profiletop)
+    if options.profilestats:
+        stats.dump_stats(options.profilestats)
+    sampler.report(options.profiletop)
+
+
+def blockMetrics(p:dict):
+    counts, timers = p["stats"].snapshot()
+    seconds = 0.0
+    if "elapsed" in p:
+        seconds = p["elapsed"]
+    m = {"name": blockName(p), "source": p["source"], "dest": p["dest"],
+         "seconds": seconds, "counters": counts, "timers": timers,
+         "slowest": [{"path": path, "seconds": s} for s, path in p["stats"].slowest()]}
+    # overall rate, and the rate the copies ran at while they ran
+    m["mbps"] = 0.0
+    if 0 < seconds:
+        m["mbps"] = counts.get("bytes", 0) / 1e6 / seconds
+    m["copy_mbps"] = 0.0
+    if 0 < timers.get("copy", 0.0):
+        m["copy_mbps"] = counts.get("bytes", 0) / 1e6 / timers["copy"]
+    return m
+
+
+def promLabel(value:str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def writeMetrics(path:str, process:list, started:float, elapsed:float):
+    # a file ending in .prom gets the Prometheus text format, for the
+    # node exporter's textfile collector, anything else gets JSON
+    blocks = [blockMetrics(p) for p in process if "stats" in p]
+    if path.endswith(".prom"):
+        lines = ["# HELP backup_last_run_timestamp_seconds When the last backup run started",
+                 "# TYPE backup_last_run_timestamp_seconds gauge",
+                 "backup_last_run_timestamp_seconds " + str(started),
+                 "# HELP backup_run_seconds How long the last backup run took",
+                 "# TYPE backup_run_seconds gauge",
+                 "backup_run_seconds " + str(elapsed),
+                 "# HELP backup_block_seconds How long each config block took",
+                 "# TYPE backup_block_seconds gauge"]
+        for m in blocks:
+            lines.append('backup_block_seconds{block="' + promLabel(m["name"]) + '"} ' + str(m["seconds"]))
+        lines.extend(["# HELP backup_events Files and filesystem calls, by kind",
+                      "# TYPE backup_events gauge"])
+        for m in blocks:
+            for key in sorted(m["counters"]):
+                lines.append('backup_events{block="' + promLabel(m["name"]) + '",kind="' + promLabel(key) + '"} ' + str(m["counters"][key]))
+        lines.extend(["# HELP backup_phase_seconds Time spent in each phase - copy time is summed over the copy workers",
+                      "# TYPE backup_phase_seconds gauge"])
+        for m in blocks:
+            for key in sorted(m["timers"]):
+                lines.append('backup_phase_seconds{block="' + promLabel(m["name"]) + '",phase="' + key + '"} ' + str(m["timers"][key]))
+        lines.extend(["# HELP backup_copy_mbps Rate data was copied at, in MB/s",
+                      "# TYPE backup_copy_mbps gauge"])
+        for m in blocks:
+            lines.append('backup_copy_mbps{block="' + promLabel(m["name"]) + '",over="run"} ' + str(m["mbps"]))
+            lines.append('backup_copy_mbps{block="' + promLabel(m["name"]) + '",over="copies"} ' + str(m["copy_mbps"]))
+        text = "\n".join(lines) + "\n"
+    else:
+        text = json.dumps({"started": started, "seconds": elapsed, "blocks": blocks}, indent=1) + "\n"
+    # write it whole, so a collector never sees half of it
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError as err:
+        print("Metrics file", path, "could not be written:", err)
+
+
+def main(argv:list=None):
 
     signal.signal(signal.SIGINT, signal_handler)
 
@@ -373,8 +3197,29 @@ def main():
     debugGroup.add_option("--dryrun",
                           action="store_true", dest="dryrun", default=False,
                           help="Show commands, but do not execute them")
+    debugGroup.add_option("--logformat", dest="logformat", choices=logFormats,
+                          help="Format of the log: text (default) or json, one record per line")
     debugGroup.add_option("--log", dest="log",
                          help="File in which the processing log shall be stored")
+    debugGroup.add_option("--summary",
+                          action="store_true", dest="summary", default=False,
+                          help="Print a table of what each config block did at the end of the run")
+    debugGroup.add_option("--metrics", dest="metrics",
+                          help="File to write the run's counters and timings to - Prometheus text format if it ends in .prom, JSON otherwise")
+    debugGroup.add_option("--profile",
+                          action="store_true", dest="profile", default=False,
+                          help="Profile the run and report the most expensive subtrees of each config block")
+    debugGroup.add_option("--profiletop", dest="profiletop", type="int", default=20,
+                          help="Number of subtrees and functions in the profile report (default: 20)")
+    debugGroup.add_option("--profilestats", dest="profilestats",
+                          help="File to save the cProfile data to, for use with pstats")
+    debugGroup.add_option("--plan", dest="plan",
+                          help="Only decide what to do, and write it to this manifest file (.gz to compress)")
+    debugGroup.add_option("--apply-manifest", dest="apply",
+                          help="Carry out the actions in a manifest written by --plan")
+    debugGroup.add_option("--verify",
+                          action="store_true", dest="verify", default=False,
+                          help="Ignore the snapshot index and rescan the target directories")
     parser.add_option_group(debugGroup)
 
     execGroup = OptionGroup(parser, "Execution Options")
@@ -402,9 +3247,120 @@ def main():
     execGroup.add_option("--noallext",
                          action="store_false", dest="allext", default=True,
                          help="Do not backup files of same name but with different extensions")
+    execGroup.add_option("--jobs", dest="jobs",
+                         help="Number of files to copy in parallel, or auto to adjust it to what the destination can take (default: 1)")
+    execGroup.add_option("--bwlimit", dest="bwlimit",
+                         help="Limit on the rate the whole run copies at, e.g. 10M, or 10M@08:00-20:00 to only apply it during those hours")
+    execGroup.add_option("--scanjobs", dest="scanjobs", type="int",
+                         help="Number of directories to scan in parallel (default: 1)")
+    execGroup.add_option("--bufsize", dest="bufsize",
+                         help="Size of the copy buffer, e.g. 4M (default: 1M)")
+    execGroup.add_option("--compare", dest="compare", choices=compareModes,
+                         help="How to decide a file has changed: mtime (default), size, mtime+size or hash")
+    execGroup.add_option("--index", dest="index",
+                         help="File in which to keep a snapshot of the target trees between runs")
+    execGroup.add_option("--store", dest="store",
+                         help="Directory of a content-addressed store to keep files in, so that identical files are only copied and stored once")
+    execGroup.add_option("--pack", dest="pack",
+                         help="Pack files smaller than this, e.g. 64K, into a tar file per directory instead of copying them one by one")
+    execGroup.add_option("--restore", dest="restore",
+                         help="Get a packed file back out of its pack - give the path it would have in DEST")
+    execGroup.add_option("--restoreto", dest="restoreto",
+                         help="Where to put the file --restore gets back (default: where it would be in DEST)")
+    execGroup.add_option("--journal", dest="journal",
+                         help="Directory in which to keep the journals that let an interrupted run resume")
+    execGroup.add_option("--snapshot",
+                         action="store_true", dest="snapshot", default=False,
+                         help="Write each run to a new dated snapshot under DEST, hard-linking unchanged files from the previous one")
+    execGroup.add_option("--delta",
+                         action="store_true", dest="delta", default=False,
+                         help="Only rewrite the blocks of large files that have changed, using a signature kept beside each one in DEST")
+    execGroup.add_option("--quickscan",
+                         action="store_true", dest="quickscan", default=False,
+                         help="Don't check files in directories whose mtime is unchanged since the last run (requires --index)")
+    execGroup.add_option("--watch",
+                         action="store_true", dest="watch", default=False,
+                         help="Keep running after the first pass, backing up changes as they are made")
+    execGroup.add_option("--debounce", dest="debounce", type="float", default=2.0,
+                         help="Seconds a directory must be left alone before --watch backs up its changes (default: 2)")
+    execGroup.add_option("--reconcile", dest="reconcile", type="float", default=3600.0,
+                         help="Seconds between the full scans --watch does to catch what the change events missed (default: 3600)")
+    execGroup.add_option("--parallel", dest="parallel", type="int", default=1,
+                         help="Number of config blocks to process at the same time (default: 1)")
+    execGroup.add_option("--perdest", dest="perdest", type="int", default=1,
+                         help="Number of config blocks that may write to the same destination volume at the same time (default: 1)")
     parser.add_option_group(execGroup)
 
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv)
+    started = time.time()
+    runstart = time.monotonic()
+    if options.profile:
+        profiler = cProfile.Profile()
+        sampler = Sampler()
+        sampler.start()
+        profiler.enable()
+
+    bufsize = None
+    if options.bufsize:
+        try:
+            bufsize = parseSize(options.bufsize)
+        except ValueError:
+            print("Invalid buffer size:", options.bufsize)
+            sys.exit(1)
+
+    jobs = None
+    if options.jobs:
+        try:
+            jobs = parseJobs(options.jobs)
+        except ValueError:
+            print("Invalid number of jobs:", options.jobs)
+            sys.exit(1)
+        # config files are validated before this gets applied to them
+        if jobs != "auto" and jobs < 1:
+            print("jobs must be at least 1")
+            sys.exit(1)
+    if options.bwlimit:
+        try:
+            parseBwlimit(options.bwlimit)
+        except ValueError:
+            print("Invalid bandwidth limit:", options.bwlimit)
+            sys.exit(1)
+
+    if options.parallel < 1 or options.perdest < 1:
+        print("--parallel and --perdest must be at least 1")
+        sys.exit(1)
+
+    if options.watch and (options.debounce < 0 or options.reconcile <= 0):
+        print("--debounce can't be negative and --reconcile must be positive")
+        sys.exit(1)
+
+    pack = None
+    if options.pack:
+        try:
+            pack = parseSize(options.pack)
+        except ValueError:
+            print("Invalid pack size:", options.pack)
+            sys.exit(1)
+
+    if options.restore:
+        if options.restoreto:
+            out = options.restoreto
+        else:
+            out = options.restore
+        if not restorePacked(options.restore, out):
+            sys.exit(1)
+        return []
+
+    if options.apply:
+        process = applyManifest(options.apply, options)
+        if options.summary:
+            printSummary(process)
+        if options.metrics:
+            writeMetrics(options.metrics, process, started, time.monotonic() - runstart)
+        if options.profile:
+            finishProfile(options, profiler, sampler, process)
+        stopLogging()
+        return process
 
     # setup the list of things to process
     process = []
@@ -444,7 +3400,17 @@ def main():
         if options.noupdate:
             config["noupdate"] = True
         if not options.allext:
-            config["allext"] = False
+            config["noallext"] = True
+        if jobs is not None:
+            config["jobs"] = jobs
+        if options.scanjobs:
+            config["scanjobs"] = options.scanjobs
+        if options.quickscan:
+            config["quickscan"] = True
+        if bufsize:
+            config["bufsize"] = bufsize
+        if options.compare:
+            config["compare"] = options.compare
         if options.excludedir:
             config["excludedir"] = options.excludedir.split(',')
         if options.includedir:
@@ -498,7 +3464,7 @@ def main():
                 if options.debug:
                     print("expanded input", expinput)
                 # extract the cmd before the colon
-                cmd, tgt = expinput.split(':')
+                cmd, tgt = expinput.split(':', 1)
                 tgt = tgt.strip()
                 if options.debug:
                     print("command", cmd)
@@ -540,13 +3506,75 @@ def main():
                     print("Config file", f, "contained an error - not processing")
 
     for p in process:
-        if "title" in p:
-            if "log" in p:
-                tmp = "Processing: " + p["title"]
-                p["log"].debug(tmp)
-            else:
-                print("Processing:", p["title"])
-        backupDir(p)
+        # the cmd line settings override the config file
+        if jobs is not None:
+            p["jobs"] = jobs
+        if options.bwlimit:
+            p["bwlimit"] = options.bwlimit
+        if options.scanjobs:
+            p["scanjobs"] = options.scanjobs
+        if bufsize:
+            p["bufsize"] = bufsize
+        if options.compare:
+            p["compare"] = options.compare
+        if options.index:
+            p["index"] = options.index
+        if options.journal:
+            p["journal"] = options.journal
+        if options.logformat:
+            p["logformat"] = options.logformat
+        if options.profile:
+            p["profiling"] = True
+        if options.verify:
+            p["verify"] = True
+        if options.snapshot:
+            p["snapshot"] = True
+        if options.store:
+            p["store"] = options.store
+        if pack:
+            p["pack"] = pack
+        if options.delta:
+            p["delta"] = True
+        p["volume"] = destVolume(p["dest"])
+
+    manifest = None
+    if options.plan:
+        try:
+            manifest = Manifest(options.plan)
+        except OSError as err:
+            print("Manifest", options.plan, "could not be created:", err)
+            sys.exit(1)
+        for p in process:
+            p["manifest"] = manifest
+
+    # blocks reading the same source tree share a single walk of it
+    groups = groupBlocks(process)
+    if options.parallel and options.parallel > 1:
+        runParallel(groups, options.parallel, options.perdest)
+    else:
+        runAll(groups)
+
+    if options.watch and manifest is None:
+        watchGroups(groups, options.debounce, options.reconcile)
+
+    if manifest is not None:
+        manifest.close()
+        files = 0
+        nbytes = 0
+        for p in process:
+            if "stats" in p:
+                files += p["stats"].get("planned")
+                nbytes += p["stats"].get("plannedbytes")
+        print("Planned:", files, "files,", "{:.1f}".format(nbytes / 1e6), "MB")
+
+    if options.summary or (options.parallel and options.parallel > 1):
+        printSummary(process)
+    if options.metrics:
+        writeMetrics(options.metrics, process, started, time.monotonic() - runstart)
+    if options.profile:
+        finishProfile(options, profiler, sampler, process)
+    stopLogging()
+    return process
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import os, os.path, sys, json, time, shutil, subprocess, tempfile, platform
+import resource
+from optparse import OptionParser
+
+import backup
+
+
+# the synthetic trees, as (number of directories, files per directory,
+# file size, nesting) - nested trees put each directory inside the
+# previous one rather than side by side
+shapes = {
+    "small": (50, 100, 4 * 1024, False),
+    "huge": (1, 3, 64 * 1024 * 1024, False),
+    "deep": (40, 10, 16 * 1024, True),
+    "wide": (1, 10000, 2 * 1024, False),
+}
+
+scenarios = ["full", "noop", "partial", "filtered"]
+
+
+def makeTree(top:str, shape:str, scale:float):
+    ndirs, nfiles, size, nested = shapes[shape]
+    nfiles = max(1, int(nfiles * scale))
+    block = os.urandom(64 * 1024)
+    path = top
+    for d in range(ndirs):
+        if nested:
+            path = os.path.join(path, "d" + str(d))
+        else:
+            path = os.path.join(top, "d" + str(d))
+        os.makedirs(path, exist_ok=True)
+        for f in range(nfiles):
+            # alternate extensions so there is something to filter on
+            if f % 2:
+                name = "f" + str(f) + ".dat"
+            else:
+                name = "f" + str(f) + ".txt"
+            with open(os.path.join(path, name), "wb") as out:
+                left = size
+                while 0 < left:
+                    n = min(left, len(block))
+                    out.write(block[:n])
+                    left -= n
+
+
+def treeFiles(top:str):
+    files = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        for f in filenames:
+            files.append(os.path.join(dirpath, f))
+    return sorted(files)
+
+
+def prepare(scenario:str, src:str, dest:str, extra:list):
+    # get the destination into the state the scenario starts from
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+    if scenario in ["noop", "partial"]:
+        # in a process of its own, or the memory it used would be
+        # counted against the run being measured
+        subprocess.run([sys.executable, os.path.abspath(backup.__file__), "--src", src, "--dest", dest] + extra,
+                       check=True, stdout=subprocess.DEVNULL)
+    if scenario == "partial":
+        # remove a quarter of the backup and make
+        # another quarter of the source newer
+        later = time.time() + 10
+        for n, f in enumerate(treeFiles(src)):
+            if n % 4 == 1:
+                os.unlink(os.path.join(dest, os.path.relpath(f, src)))
+            elif n % 4 == 2:
+                os.utime(f, (later, later))
+
+
+def runScenario(shape:str, scenario:str, src:str, dest:str, extra:list):
+    prepare(scenario, src, dest, extra)
+    argv = ["--src", src, "--dest", dest] + extra
+    if scenario == "filtered":
+        argv += ["--includefile", "*.dat", "--excludedir", "d1*"]
+    start = time.monotonic()
+    process = backup.main(argv)
+    elapsed = time.monotonic() - start
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # reported in bytes rather than KB
+        rss = rss // 1024
+    files = len(treeFiles(src))
+    copied = 0
+    nbytes = 0
+    syscalls = 0
+    for p in process:
+        copied += p["stats"].get("copied")
+        nbytes += p["stats"].get("bytes")
+        for e in ["scandir", "stat", "mkdir"]:
+            syscalls += p["stats"].get(e)
+    return {"shape": shape, "scenario": scenario, "files": files,
+            "copied": copied, "bytes": nbytes, "seconds": round(elapsed, 4),
+            "files_per_sec": round(files / elapsed, 1),
+            "mb_per_sec": round(nbytes / 1e6 / elapsed, 2),
+            "syscalls": syscalls, "peak_rss_kb": rss}
+
+
+def runWorker(work:str, shape:str, scenario:str, extra:list):
+    # each scenario runs in its own process so that its
+    # peak memory use is its own
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker",
+           "--workdir", work, "--shapes", shape, "--scenarios", scenario]
+    if extra:
+        cmd += ["--args", " ".join(extra)]
+    out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def printResults(results:list, baseline:dict):
+    print("{:<8} {:<9} {:>8} {:>8} {:>9} {:>11} {:>9} {:>9} {:>10}".format(
+          "Shape", "Scenario", "Files", "Copied", "Seconds", "Files/sec",
+          "MB/sec", "Syscalls", "RSS (KB)"))
+    for r in results:
+        line = "{:<8} {:<9} {:>8} {:>8} {:>9.3f} {:>11.1f} {:>9.2f} {:>9} {:>10}".format(
+               r["shape"], r["scenario"], r["files"], r["copied"], r["seconds"],
+               r["files_per_sec"], r["mb_per_sec"], r["syscalls"], r["peak_rss_kb"])
+        key = (r["shape"], r["scenario"])
+        if key in baseline and 0 < baseline[key]["seconds"]:
+            change = (r["seconds"] / baseline[key]["seconds"] - 1) * 100
+            line += "  {:+.1f}% time".format(change)
+        print(line)
+
+
+def main():
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("--shapes", dest="shapes", default=",".join(shapes),
+                      help="Comma-delimited list of trees to generate: " + ", ".join(shapes))
+    parser.add_option("--scenarios", dest="scenarios", default=",".join(scenarios),
+                      help="Comma-delimited list of scenarios to run: " + ", ".join(scenarios))
+    parser.add_option("--scale", dest="scale", type="float", default=1.0,
+                      help="Multiply the number of files per directory by this")
+    parser.add_option("--args", dest="args", default="",
+                      help="Extra options to pass to backup.py, e.g. \"--jobs 4\"")
+    parser.add_option("--workdir", dest="workdir",
+                      help="Directory in which to build the trees (default: a temporary directory)")
+    parser.add_option("--json", dest="json",
+                      help="File in which to save the results")
+    parser.add_option("--baseline", dest="baseline",
+                      help="Results saved by an earlier run to compare against")
+    parser.add_option("--worker", action="store_true", dest="worker", default=False,
+                      help="Internal: run a single scenario and print its result")
+    (options, args) = parser.parse_args()
+
+    extra = options.args.split()
+    shapeList = options.shapes.split(',')
+    scenarioList = options.scenarios.split(',')
+    for s in shapeList:
+        if s not in shapes:
+            print("Unknown shape:", s)
+            sys.exit(1)
+    for s in scenarioList:
+        if s not in scenarios:
+            print("Unknown scenario:", s)
+            sys.exit(1)
+
+    if options.worker:
+        src = os.path.join(options.workdir, shapeList[0], "src")
+        dest = os.path.join(options.workdir, shapeList[0], "dest")
+        result = runScenario(shapeList[0], scenarioList[0], src, dest, extra)
+        print(json.dumps(result))
+        return
+
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline, "r") as f:
+            for r in json.load(f)["results"]:
+                baseline[(r["shape"], r["scenario"])] = r
+
+    if options.workdir:
+        work = options.workdir
+        cleanup = False
+    else:
+        work = tempfile.mkdtemp(prefix="backup-bench-")
+        cleanup = True
+
+    results = []
+    try:
+        for shape in shapeList:
+            src = os.path.join(work, shape, "src")
+            if os.path.exists(src):
+                shutil.rmtree(src)
+            makeTree(src, shape, options.scale)
+            for scenario in scenarioList:
+                results.append(runWorker(work, shape, scenario, extra))
+    finally:
+        if cleanup:
+            shutil.rmtree(work)
+
+    printResults(results, baseline)
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "args": options.args, "scale": options.scale,
+                       "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()